@@ -0,0 +1,124 @@
+"""
+Compares the reduced precision modes against fp32 on the logit lens: the top-1 agreement of every
+layer's most likely token with the fp32 model, and the speedup.
+
+Usage:
+    uv run python -m benchmarks.precision --model gpt2-small --device cpu
+"""
+
+import argparse
+import statistics
+import time
+from transformer_lens import HookedTransformer
+from src.precision import PRECISIONS, load_with_precision
+from src.schemas import LogitLensRequest, LogitLensResponse
+from src.services.logitlens import logitlens
+
+PROMPTS = [
+    "Tom Cruise is the star of the movie Mission:",
+    "The capital of France is",
+    "def fibonacci(n):\n    if n < 2:\n        return n\n    return",
+    "After the rain stopped, the children ran outside to play in the",
+    "The mitochondria is the powerhouse of the",
+]
+
+
+def run_logitlens(
+    model: HookedTransformer, prompts: list[str], repeats: int
+) -> tuple[list[LogitLensResponse], float]:
+    """Runs the logit lens on every prompt repeats times.
+
+    Returns:
+        The responses and the median time of a pass over all prompts in seconds
+    """
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        responses = [
+            logitlens(LogitLensRequest(model_name=model.cfg.model_name, input=prompt), model)
+            for prompt in prompts
+        ]
+        times.append(time.perf_counter() - start)
+
+    return responses, statistics.median(times)
+
+
+def top1_agreement(
+    reference: list[LogitLensResponse], responses: list[LogitLensResponse]
+) -> tuple[float, float]:
+    """Returns the fraction of (prompt, layer, position) most likely tokens and the fraction of
+    final predictions that match the reference."""
+
+    matches = total = 0
+    for reference_response, response in zip(reference, responses):
+        for reference_layer, layer in zip(reference_response.logit_lens, response.logit_lens):
+            for reference_token, token in zip(
+                reference_layer.max_prob_tokens, layer.max_prob_tokens
+            ):
+                matches += reference_token == token
+                total += 1
+
+    final_matches = sum(
+        reference_response.most_likely_token == response.most_likely_token
+        for reference_response, response in zip(reference, responses)
+    )
+    return matches / total, final_matches / len(reference)
+
+
+def benchmark(
+    models: dict[str, HookedTransformer], prompts: list[str], repeats: int
+) -> list[dict]:
+    """Benchmarks each model against models["fp32"].
+
+    Returns:
+        One row per precision with its time, speedup and top-1 agreements
+    """
+
+    reference, reference_time = run_logitlens(models["fp32"], prompts, repeats)
+
+    rows = []
+    for precision, model in models.items():
+        responses, seconds = run_logitlens(model, prompts, repeats)
+        layer_agreement, final_agreement = top1_agreement(reference, responses)
+        rows.append(
+            {
+                "precision": precision,
+                "seconds": seconds,
+                "speedup": reference_time / seconds,
+                "layer_top1_agreement": layer_agreement,
+                "final_top1_agreement": final_agreement,
+            }
+        )
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--model", default="gpt2-small")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--precisions", nargs="+", default=list(PRECISIONS), choices=PRECISIONS)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    precisions = ["fp32"] + [precision for precision in args.precisions if precision != "fp32"]
+    models = {
+        precision: load_with_precision(args.model, args.device, precision)
+        for precision in precisions
+    }
+
+    # Warm up, e.g. the vocab string table and kernel selection
+    for model in models.values():
+        run_logitlens(model, PROMPTS[:1], 1)
+
+    print(f"{'precision':<10}{'seconds':>10}{'speedup':>10}{'layer top-1':>14}{'final top-1':>14}")
+    for row in benchmark(models, PROMPTS, args.repeats):
+        print(
+            f"{row['precision']:<10}{row['seconds']:>10.3f}{row['speedup']:>10.2f}"
+            f"{row['layer_top1_agreement']:>14.3f}{row['final_top1_agreement']:>14.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
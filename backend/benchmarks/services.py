@@ -0,0 +1,333 @@
+"""
+Benchmarks the latency, throughput and peak memory of the logit lens and steering services on
+randomly initialized models of several sizes, across batch sizes and sequence lengths. Needs no
+network access or downloaded weights.
+
+Results are compared against a baseline file (benchmarks/baseline.json by default) holding the
+results of a previous run and the regression thresholds; the command exits with status 1 when a
+case regressed. Regenerate the baseline on the machine used for comparisons with --update-baseline.
+
+Usage:
+    uv run python -m benchmarks.services
+    uv run python -m benchmarks.services --sizes tiny small --update-baseline
+"""
+
+import argparse
+import ctypes
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable
+import torch as t
+from transformer_lens import HookedTransformer
+import src.config as config
+from src.schemas import (
+    LogitLensBatchRequest,
+    LogitLensRequest,
+    RunWithSteeringRequest,
+    SteeringVectorRequest,
+)
+from src.services.logitlens import logitlens, logitlens_batch
+from src.services.steering import calculate_steering_vectors, run_with_steering
+from benchmarks.synthetic import SIZES, random_text, synthetic_model
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# A case regresses when its value exceeds baseline * (1 + relative) + absolute. Latencies on shared
+# CPUs vary by tens of percent between runs, so only large slowdowns are flagged.
+DEFAULT_THRESHOLDS = {
+    "latency_ms": {"relative": 0.5, "absolute": 2.0},
+    "peak_memory_mb": {"relative": 0.25, "absolute": 16.0},
+}
+
+BATCH_SIZES = (1, 8)
+SEQUENCE_LENGTHS = (16, 128)
+MAX_TOKENS = 32
+
+
+@dataclass
+class Case:
+    name: str
+    run: Callable[[], object]
+    # Units processed per run, e.g. tokens or prompts, for the throughput
+    units: int
+    unit: str
+
+
+@dataclass
+class Result:
+    latency_ms: float
+    throughput: float
+    unit: str
+    peak_memory_mb: float | None
+
+
+def build_cases(model: HookedTransformer, size: str, rng: random.Random) -> list[Case]:
+    """Returns the cases of one model: the logit lens and the steering vector calculation for every
+    batch size and sequence length, and a steered run for every sequence length."""
+
+    d_vocab = model.cfg.d_vocab
+    model_name = model.cfg.model_name
+    cases = []
+
+    for batch_size in BATCH_SIZES:
+        for seq_len in SEQUENCE_LENGTHS:
+            inputs = [random_text(seq_len, d_vocab, rng) for _ in range(batch_size)]
+            if batch_size == 1:
+                request = LogitLensRequest(model_name=model_name, input=inputs[0])
+                run = lambda request=request: logitlens(request, model)
+            else:
+                request = LogitLensBatchRequest(model_name=model_name, inputs=inputs)
+                run = lambda request=request: logitlens_batch(request, model)
+            name = f"{size}/logitlens/b{batch_size}/s{seq_len}"
+            cases.append(Case(name, run, batch_size * seq_len, "tokens"))
+
+    for batch_size in BATCH_SIZES:
+        for seq_len in SEQUENCE_LENGTHS:
+            # Half of the tokens in the user turn, half in each assistant response
+            request = SteeringVectorRequest(
+                model_name=model_name,
+                user_prompts=[random_text(seq_len // 2, d_vocab, rng) for _ in range(batch_size)],
+                assistant_positive_responses=[
+                    random_text(seq_len // 2, d_vocab, rng) for _ in range(batch_size)
+                ],
+                assistant_negative_responses=[
+                    random_text(seq_len // 2, d_vocab, rng) for _ in range(batch_size)
+                ],
+                return_vectors=False,
+            )
+            cases.append(
+                Case(
+                    f"{size}/calculate_steering_vectors/b{batch_size}/s{seq_len}",
+                    lambda request=request: calculate_steering_vectors(request, model),
+                    2 * batch_size,
+                    "prompts",
+                )
+            )
+
+    steering_vectors = {
+        layer: t.randn(model.cfg.d_model).tolist() for layer in range(model.cfg.n_layers)
+    }
+    for seq_len in SEQUENCE_LENGTHS:
+        request = RunWithSteeringRequest(
+            model_name=model_name,
+            prompt=random_text(seq_len, d_vocab, rng),
+            steering_vectors=steering_vectors,
+            layer=model.cfg.n_layers // 2,
+            scaling_factor=4.0,
+            max_tokens=MAX_TOKENS,
+        )
+        cases.append(
+            Case(
+                f"{size}/run_with_steering/s{seq_len}",
+                lambda request=request: run_with_steering(request, model),
+                # The steered and unsteered responses
+                2 * MAX_TOKENS,
+                "tokens",
+            )
+        )
+
+    return cases
+
+
+def _read_status_kb(field: str) -> int | None:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_memory(device: t.device) -> int | None:
+    """Resets the peak memory counter and returns the current memory use in bytes."""
+
+    if device.type == "cuda":
+        t.cuda.synchronize(device)
+        t.cuda.reset_peak_memory_stats(device)
+        return t.cuda.memory_allocated(device)
+
+    # Return the memory freed by earlier runs to the OS, so that reusing it counts again
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+    # Writing 5 to clear_refs resets the peak resident set size (VmHWM) on Linux
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return None
+    rss_kb = _read_status_kb("VmRSS")
+    return rss_kb * 1024 if rss_kb is not None else None
+
+
+def _peak_memory(device: t.device) -> int | None:
+    if device.type == "cuda":
+        t.cuda.synchronize(device)
+        return t.cuda.max_memory_allocated(device)
+
+    peak_kb = _read_status_kb("VmHWM")
+    return peak_kb * 1024 if peak_kb is not None else None
+
+
+def run_case(case: Case, device: t.device, repeats: int) -> Result:
+    """Runs a case once to warm up, then repeats times.
+
+    Returns:
+        The median latency and its throughput, and the peak memory above the memory in use before
+        the runs (the process's resident set size on the CPU, allocated memory on CUDA)
+    """
+
+    case.run()
+
+    start_memory = _reset_peak_memory(device)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        case.run()
+        if device.type == "cuda":
+            t.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    peak_memory = _peak_memory(device)
+
+    latency = statistics.median(times)
+    peak_memory_mb = None
+    if start_memory is not None and peak_memory is not None:
+        peak_memory_mb = max(peak_memory - start_memory, 0) / 2**20
+
+    return Result(
+        latency_ms=latency * 1000,
+        throughput=case.units / latency,
+        unit=case.unit,
+        peak_memory_mb=peak_memory_mb,
+    )
+
+
+def find_regressions(
+    results: dict[str, Result], baseline: dict
+) -> list[tuple[str, str, float, float]]:
+    """Compares results to a baseline file's results with its thresholds.
+
+    Returns:
+        (case, metric, baseline value, value) for every regressed metric
+    """
+
+    thresholds = baseline.get("thresholds", DEFAULT_THRESHOLDS)
+    regressions = []
+
+    for name, result in results.items():
+        reference = baseline["results"].get(name)
+        if reference is None:
+            continue
+
+        for metric, threshold in thresholds.items():
+            value, reference_value = getattr(result, metric), reference.get(metric)
+            if value is None or reference_value is None:
+                continue
+            limit = reference_value * (1 + threshold["relative"]) + threshold["absolute"]
+            if value > limit:
+                regressions.append((name, metric, reference_value, value))
+
+    return regressions
+
+
+def environment(device: t.device) -> dict:
+    """Describes where the results were measured."""
+
+    return {
+        "python": platform.python_version(),
+        "torch": t.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": t.get_num_threads(),
+        "device": str(device),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES), choices=list(SIZES))
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 for the default")
+    parser.add_argument("--filter", default="", help="only run the cases containing this string")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        t.set_num_threads(args.threads)
+    device = t.device(args.device)
+
+    # Keep the registry writes out of the working directory, and run every prompt every time
+    config.STEERING_VECTOR_DIR = tempfile.mkdtemp(prefix="benchmark-steering-vectors-")
+    config.ACTIVATION_STORE_DIR = ""
+
+    rng = random.Random(0)
+    results: dict[str, Result] = {}
+
+    print(f"{'case':<48}{'latency ms':>12}{'throughput':>20}{'peak MB':>10}")
+    for size in args.sizes:
+        model = synthetic_model(size, args.device)
+        for case in build_cases(model, size, rng):
+            if args.filter not in case.name:
+                continue
+            result = results[case.name] = run_case(case, device, args.repeats)
+            peak = f"{result.peak_memory_mb:.1f}" if result.peak_memory_mb is not None else "-"
+            print(
+                f"{case.name:<48}{result.latency_ms:>12.2f}"
+                f"{f'{result.throughput:.1f} {result.unit}/s':>20}{peak:>10}"
+            )
+        del model
+
+    report = {
+        "environment": environment(device),
+        "repeats": args.repeats,
+        "results": {name: asdict(result) for name, result in results.items()},
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        thresholds = DEFAULT_THRESHOLDS
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                thresholds = json.load(f).get("thresholds", DEFAULT_THRESHOLDS)
+        with open(args.baseline, "w") as f:
+            json.dump({"thresholds": thresholds, **report}, f, indent=2)
+            f.write("\n")
+        print(f"Wrote the baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --update-baseline to create one")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("environment") != report["environment"]:
+        print("The baseline was measured in a different environment, expect noise")
+
+    regressions = find_regressions(results, baseline)
+    for name, metric, reference_value, value in regressions:
+        print(f"REGRESSION {name} {metric}: {reference_value:.2f} -> {value:.2f}")
+    if regressions:
+        sys.exit(1)
+    print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
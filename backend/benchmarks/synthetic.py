@@ -0,0 +1,93 @@
+"""
+Randomly initialized HookedTransformer models with a word-level tokenizer, built without network
+access, for benchmarking the services on any machine.
+"""
+
+import random
+import tempfile
+import torch as t
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+from transformers import PreTrainedTokenizerFast
+
+SPECIAL_TOKENS = ["<pad>", "<bos>", "<eos>", "<start_of_turn>", "<end_of_turn>", "user", "model"]
+
+# A Gemma-style template, so the steering services see the same prompt structure as on real models
+CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for m in messages %}<start_of_turn> "
+    "{{ 'model' if m['role'] == 'assistant' else m['role'] }} {{ m['content'] }} <end_of_turn> "
+    "{% endfor %}{% if add_generation_prompt %}<start_of_turn> model {% endif %}"
+)
+
+# name: (n_layers, d_model, n_heads, d_vocab)
+SIZES = {
+    "tiny": (2, 64, 4, 1024),
+    "small": (4, 128, 4, 4096),
+    "medium": (6, 256, 8, 16384),
+}
+
+
+def synthetic_tokenizer(d_vocab: int) -> PreTrainedTokenizerFast:
+    """Returns a tokenizer mapping each whitespace-separated word w0, w1, ... to its own token."""
+
+    words = SPECIAL_TOKENS + [f"w{idx}" for idx in range(d_vocab - len(SPECIAL_TOKENS))]
+    tokenizer = Tokenizer(
+        models.WordLevel(vocab={word: idx for idx, word in enumerate(words)}, unk_token="<pad>")
+    )
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer.decoder = decoders.WordPiece(prefix="##")
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token="<pad>", bos_token="<bos>", eos_token="<eos>"
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+
+    # TransformerLens reloads the tokenizer from its name_or_path, so it needs to be on disk
+    path = tempfile.mkdtemp(prefix="synthetic-tokenizer-")
+    tokenizer.save_pretrained(path)
+    return PreTrainedTokenizerFast.from_pretrained(path)
+
+
+def synthetic_model(size: str, device: str = "cpu", seed: int = 0) -> HookedTransformer:
+    """Builds a randomly initialized model of one of SIZES.
+
+    The EOS token is made unreachable so that generation always runs to max_tokens and timings are
+    comparable between runs.
+    """
+
+    n_layers, d_model, n_heads, d_vocab = SIZES[size]
+    t.manual_seed(seed)
+
+    cfg = HookedTransformerConfig(
+        model_name=f"synthetic-{size}",
+        n_layers=n_layers,
+        d_model=d_model,
+        d_head=d_model // n_heads,
+        n_heads=n_heads,
+        d_mlp=4 * d_model,
+        d_vocab=d_vocab,
+        n_ctx=1024,
+        act_fn="gelu",
+        normalization_type="LN",
+        positional_embedding_type="standard",
+        default_prepend_bos=False,
+        device=device,
+    )
+    model = HookedTransformer(
+        cfg, tokenizer=synthetic_tokenizer(d_vocab), default_padding_side="right"
+    )
+    model.cfg.default_prepend_bos = False
+    model.eval()
+
+    with t.no_grad():
+        model.b_U[model.tokenizer.eos_token_id] = -1e4
+
+    return model
+
+
+def random_text(n_words: int, d_vocab: int, rng: random.Random) -> str:
+    """Returns n_words random (non-special) words, each a single token."""
+
+    return " ".join(
+        f"w{rng.randrange(d_vocab - len(SPECIAL_TOKENS))}" for _ in range(n_words)
+    )
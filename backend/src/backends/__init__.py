@@ -0,0 +1,38 @@
+import src.config as config
+from src.backends.base import RUNNER_METHODS, STREAM_METHODS, RunnerBackend, RunnerTimeout
+
+_backend: RunnerBackend | None = None
+
+
+def get_runner_backend() -> RunnerBackend:
+    """Returns the runner backend selected by config.RUNNER_BACKEND: "local" (in this process),
+    "process" (one local process per model), "modal", or "fake_modal" (the Modal backend calling
+    FakeModalRunner instances instead of Modal)."""
+
+    global _backend
+
+    if _backend is None:
+        if config.RUNNER_BACKEND == "modal":
+            from src.backends.modal_backend import ModalRunnerBackend
+
+            _backend = ModalRunnerBackend()
+        elif config.RUNNER_BACKEND == "fake_modal":
+            from src.backends.fake_modal import FakeModalRunner
+            from src.backends.modal_backend import ModalRunnerBackend
+
+            _backend = ModalRunnerBackend(runner_factory=FakeModalRunner)
+        elif config.RUNNER_BACKEND == "process":
+            from src.backends.process import ProcessRunnerBackend
+
+            _backend = ProcessRunnerBackend()
+        elif config.RUNNER_BACKEND == "local":
+            from src.backends.local import LocalRunnerBackend
+
+            _backend = LocalRunnerBackend()
+        else:
+            raise ValueError(f"Unknown runner backend {config.RUNNER_BACKEND}")
+
+    return _backend
+
+
+__all__ = ["RUNNER_METHODS", "STREAM_METHODS", "RunnerBackend", "RunnerTimeout", "get_runner_backend"]
@@ -0,0 +1,82 @@
+from abc import ABC, abstractmethod
+from typing import AsyncIterator
+from pydantic import BaseModel
+from src.schemas import ModelManagerState
+from src.services.logitlens import logitlens, logitlens_batch, logitlens_stream
+from src.services.sessions import (
+    create_session,
+    delete_session,
+    session_attention,
+    session_lens,
+    session_norms,
+)
+from src.services.steering import (
+    calculate_steering_vectors,
+    run_with_steering,
+    stream_with_steering,
+    sweep_steering,
+)
+
+# The methods of a model runner (see modal_app._BaseModelRunner), each calling a service function
+# with the request and the runner's model
+RUNNER_METHODS = {
+    "logitlens": logitlens,
+    "logitlens_batch": logitlens_batch,
+    "calculate_steering_vectors": calculate_steering_vectors,
+    "run_with_steering": run_with_steering,
+    "create_session": create_session,
+    "session_lens": session_lens,
+    "session_norms": session_norms,
+    "session_attention": session_attention,
+    "delete_session": delete_session,
+}
+
+# The runner methods that are generators
+STREAM_METHODS = {
+    "logitlens_stream": logitlens_stream,
+    "stream_with_steering": stream_with_steering,
+    "sweep_steering": sweep_steering,
+}
+
+
+class RunnerTimeout(Exception):
+    """Raised when a runner method takes longer than the backend's timeout."""
+
+    def __init__(self, model_name: str, method: str, timeout: float):
+        super().__init__(f"{method} on {model_name} timed out after {timeout}s")
+        self.model_name = model_name
+        self.method = method
+        self.timeout = timeout
+
+
+class RunnerBackend(ABC):
+    """
+    Runs model runner methods for the routers, in this process, in local runner processes or on
+    Modal.
+
+    stream() is awaited before its items are iterated, so that a rejected request (e.g. a full
+    queue) fails before a streaming response has started.
+    """
+
+    async def start(self):
+        """Called when the API starts."""
+
+    async def close(self):
+        """Called when the API shuts down."""
+
+    async def model_states(self) -> dict[str, ModelManagerState] | None:
+        """Returns the model manager state of each running runner, keyed by the model it runs, or
+        None if the backend cannot report them."""
+
+        return None
+
+    @abstractmethod
+    async def run(self, model_name: str, method: str, request: BaseModel) -> BaseModel:
+        """Runs a method of RUNNER_METHODS and returns its result."""
+
+    @abstractmethod
+    async def stream(
+        self, model_name: str, method: str, request: BaseModel
+    ) -> AsyncIterator[BaseModel]:
+        """Starts a method of STREAM_METHODS and returns an iterator over its items. Closing the
+        iterator stops the method."""
@@ -0,0 +1,45 @@
+import asyncio
+from functools import partial
+from types import SimpleNamespace
+from typing import AsyncIterator
+from pydantic import BaseModel
+from src.backends.base import RUNNER_METHODS, STREAM_METHODS
+from src.backends.local import LocalRunnerBackend
+
+
+class FakeModalRunner:
+    """
+    Stands in for a deployed Modal runner class without Modal: it has the same methods, with
+    Modal's .remote.aio and .remote_gen.aio interface, and runs them on a LocalRunnerBackend.
+    Used by the "fake_modal" runner backend to exercise ModalRunnerBackend (handle cache,
+    concurrency limits, timeouts) locally.
+
+    Args:
+        model_name: The model to run
+        latency_seconds: Added before each call and each streamed item, to imitate the network
+    """
+
+    def __init__(self, model_name: str, latency_seconds: float = 0.0):
+        self.model_name = model_name
+        self.latency_seconds = latency_seconds
+        self._backend = LocalRunnerBackend()
+
+        for method in RUNNER_METHODS:
+            remote = SimpleNamespace(aio=partial(self._run, method))
+            setattr(self, method, SimpleNamespace(remote=remote))
+        for method in STREAM_METHODS:
+            remote_gen = SimpleNamespace(aio=partial(self._stream, method))
+            setattr(self, method, SimpleNamespace(remote_gen=remote_gen))
+
+    async def _run(self, method: str, request: BaseModel) -> BaseModel:
+        await asyncio.sleep(self.latency_seconds)
+        return await self._backend.run(self.model_name, method, request)
+
+    async def _stream(self, method: str, request: BaseModel) -> AsyncIterator[BaseModel]:
+        items = await self._backend.stream(self.model_name, method, request)
+        try:
+            async for item in items:
+                await asyncio.sleep(self.latency_seconds)
+                yield item
+        finally:
+            await items.aclose()
@@ -0,0 +1,21 @@
+from functools import partial
+from typing import AsyncIterator
+from pydantic import BaseModel
+from src.backends.base import RUNNER_METHODS, STREAM_METHODS, RunnerBackend
+from src.inference_worker import get_worker
+
+
+class LocalRunnerBackend(RunnerBackend):
+    """Runs the methods in this process, on the InferenceWorker of each model."""
+
+    async def run(self, model_name: str, method: str, request: BaseModel) -> BaseModel:
+        worker = get_worker(model_name)
+        if method == "logitlens":
+            # Micro-batched with other logit lens requests
+            return await worker.logitlens(request)
+        return await worker.run(partial(RUNNER_METHODS[method], request))
+
+    async def stream(
+        self, model_name: str, method: str, request: BaseModel
+    ) -> AsyncIterator[BaseModel]:
+        return get_worker(model_name).stream(partial(STREAM_METHODS[method], request))
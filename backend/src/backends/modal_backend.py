@@ -0,0 +1,100 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable
+import modal
+from pydantic import BaseModel
+import src.config as config
+from src.backends.base import RunnerBackend, RunnerTimeout
+from src.metrics import metrics
+from src.modal_app import runners
+
+logger = logging.getLogger(__name__)
+
+
+def modal_runner(model_name: str):
+    """Returns a handle to the deployed Modal runner class of a model. The handle is lazy: it
+    connects to Modal on its first call."""
+
+    ModelRunner = modal.Cls.from_name(config.MODAL_APP_NAME, runners[model_name])
+    return ModelRunner()
+
+
+class ModalRunnerBackend(RunnerBackend):
+    """
+    Runs the methods on the deployed Modal runner class of each model.
+
+    Runner handles are created once per model, at startup for every model in modal_app.runners,
+    and called through Modal's async interface, so no threadpool thread waits on a call. At most
+    config.MODAL_MAX_CONCURRENT_REQUESTS requests per model are in flight; the others wait in
+    line. A call (including its wait) or the wait for the next streamed item taking longer than
+    config.MODAL_REQUEST_TIMEOUT_SECONDS raises RunnerTimeout.
+
+    Args:
+        runner_factory: Returns the runner handle of a model. Anything whose methods have Modal's
+            .remote.aio and .remote_gen.aio interface works, e.g. FakeModalRunner.
+    """
+
+    def __init__(self, runner_factory: Callable[[str], Any] = modal_runner):
+        self._runner_factory = runner_factory
+        self._runners: dict[str, Any] = {}
+        self._limits: dict[str, asyncio.Semaphore] = {}
+        self._timeout = config.MODAL_REQUEST_TIMEOUT_SECONDS or None
+
+    async def start(self):
+        for model_name in runners:
+            self._runner(model_name)
+        logger.info(f"Created runner handles for {list(self._runners)}")
+
+    async def run(self, model_name: str, method: str, request: BaseModel) -> BaseModel:
+        runner_method = getattr(self._runner(model_name), method)
+        limit = self._limit(model_name)
+
+        try:
+            async with asyncio.timeout(self._timeout):
+                async with limit:
+                    with metrics.stage("modal_dispatch", method=method):
+                        return await runner_method.remote.aio(request)
+        except TimeoutError:
+            raise RunnerTimeout(model_name, method, self._timeout)
+
+    async def stream(
+        self, model_name: str, method: str, request: BaseModel
+    ) -> AsyncIterator[BaseModel]:
+        runner_method = getattr(self._runner(model_name), method)
+        return self._iterate(model_name, method, runner_method, request)
+
+    async def _iterate(
+        self, model_name: str, method: str, runner_method, request: BaseModel
+    ) -> AsyncIterator[BaseModel]:
+        # The slot is taken when iteration starts, so a stream that is never iterated holds none
+        limit = self._limit(model_name)
+        try:
+            async with asyncio.timeout(self._timeout):
+                await limit.acquire()
+        except TimeoutError:
+            raise RunnerTimeout(model_name, method, self._timeout)
+
+        items = runner_method.remote_gen.aio(request)
+        try:
+            while True:
+                try:
+                    async with asyncio.timeout(self._timeout):
+                        item = await anext(items)
+                except StopAsyncIteration:
+                    return
+                except TimeoutError:
+                    raise RunnerTimeout(model_name, method, self._timeout)
+                yield item
+        finally:
+            await items.aclose()
+            limit.release()
+
+    def _runner(self, model_name: str):
+        if model_name not in self._runners:
+            self._runners[model_name] = self._runner_factory(model_name)
+        return self._runners[model_name]
+
+    def _limit(self, model_name: str) -> asyncio.Semaphore:
+        if model_name not in self._limits:
+            self._limits[model_name] = asyncio.Semaphore(config.MODAL_MAX_CONCURRENT_REQUESTS)
+        return self._limits[model_name]
@@ -0,0 +1,280 @@
+import asyncio
+import itertools
+import logging
+import threading
+from multiprocessing.connection import Connection
+from typing import AsyncIterator
+import torch as t
+import torch.multiprocessing as mp
+from pydantic import BaseModel
+import src.config as config
+from src.backends.base import RunnerBackend
+from src.backends.local import LocalRunnerBackend
+from src.model_manager import model_manager
+from src.schemas import ModelManagerState
+
+logger = logging.getLogger(__name__)
+
+
+def _serve(conn: Connection, model_name: str, torch_threads: int):
+    """Entry point of a runner process. Runs the requests received on conn with a
+    LocalRunnerBackend and sends back their results."""
+
+    if torch_threads > 0:
+        t.set_num_threads(torch_threads)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s [%(levelname)s] [{model_name}] %(name)s: %(message)s",
+    )
+    asyncio.run(_serve_requests(conn, model_name))
+
+
+async def _serve_requests(conn: Connection, model_name: str):
+    """Receives ("run" | "stream", request_id, method, request), ("state", request_id) and
+    ("cancel", request_id) messages and sends (request_id, kind, value) replies, where kind is
+    "result", "error", "started", "item" or "done". Requests run concurrently, so the model's
+    worker can batch and interleave them.
+    """
+
+    loop = asyncio.get_running_loop()
+    backend = LocalRunnerBackend()
+    tasks: dict[int, asyncio.Task] = {}
+
+    def send(request_id: int, kind: str, value=None):
+        try:
+            conn.send((request_id, kind, value))
+        except Exception as e:
+            # Nothing is sent when the value cannot be pickled, e.g. some exceptions
+            conn.send((request_id, "error", RuntimeError(f"{value!r} ({e})")))
+
+    async def run(request_id: int, method: str, request: BaseModel):
+        try:
+            send(request_id, "result", await backend.run(model_name, method, request))
+        except Exception as e:
+            send(request_id, "error", e)
+
+    async def stream(request_id: int, method: str, request: BaseModel):
+        try:
+            items = await backend.stream(model_name, method, request)
+        except Exception as e:
+            send(request_id, "error", e)
+            return
+
+        send(request_id, "started")
+        try:
+            async for item in items:
+                send(request_id, "item", item)
+            send(request_id, "done")
+        except Exception as e:
+            send(request_id, "error", e)
+        finally:
+            await items.aclose()
+
+    async def state(request_id: int):
+        send(request_id, "result", model_manager.state())
+
+    handlers = {"run": run, "stream": stream, "state": state}
+
+    while True:
+        try:
+            message = await loop.run_in_executor(None, conn.recv)
+        except EOFError:
+            return
+
+        kind, request_id = message[0], message[1]
+        if kind == "cancel":
+            if request_id in tasks:
+                tasks[request_id].cancel()
+            continue
+
+        task = asyncio.create_task(handlers[kind](request_id, *message[2:]))
+        tasks[request_id] = task
+        task.add_done_callback(lambda _, request_id=request_id: tasks.pop(request_id, None))
+
+
+class _RunnerProcess:
+    """A spawned process pinning one model, and the requests in flight to it."""
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+        context = mp.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_serve,
+            args=(child_conn, model_name, config.PROCESS_RUNNER_TORCH_THREADS),
+            name=f"runner-{model_name}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+        self._closed = False
+        # Set when the pipe can no longer be read, see _receive()
+        self._dead = False
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        # Replies are put on the queue of their request
+        self._pending: dict[int, tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = {}
+
+        threading.Thread(
+            target=self._receive, name=f"runner-{model_name}-receiver", daemon=True
+        ).start()
+
+    def is_alive(self) -> bool:
+        return not self._dead and self.process.is_alive()
+
+    def close(self):
+        self._closed = True
+        self.conn.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    async def run(self, method: str, request: BaseModel) -> BaseModel:
+        return await self._call("run", method, request)
+
+    async def manager_state(self) -> ModelManagerState:
+        """Returns the state of the process's model manager."""
+
+        return await self._call("state")
+
+    async def _call(self, kind: str, *args):
+        request_id, queue = self._open(kind, *args)
+        try:
+            kind, value = await queue.get()
+        except asyncio.CancelledError:
+            self._send(("cancel", request_id))
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+        if kind == "error":
+            raise value
+        return value
+
+    async def stream(self, method: str, request: BaseModel) -> AsyncIterator[BaseModel]:
+        request_id, queue = self._open("stream", method, request)
+        kind, value = await queue.get()
+        if kind == "error":
+            self._pending.pop(request_id, None)
+            raise value
+        return self._iterate(request_id, queue)
+
+    async def _iterate(self, request_id: int, queue: asyncio.Queue) -> AsyncIterator[BaseModel]:
+        finished = False
+        try:
+            while True:
+                kind, value = await queue.get()
+                if kind == "done":
+                    finished = True
+                    return
+                if kind == "error":
+                    finished = True
+                    raise value
+                yield value
+        finally:
+            self._pending.pop(request_id, None)
+            if not finished:
+                self._send(("cancel", request_id))
+
+    def _open(self, kind: str, *args) -> tuple[int, asyncio.Queue]:
+        request_id = next(self._ids)
+        queue = asyncio.Queue()
+        self._pending[request_id] = (asyncio.get_running_loop(), queue)
+        if self._dead:
+            # The receiver has already failed the pending requests
+            self._pending.pop(request_id)
+            raise RuntimeError(f"The {self.model_name} runner process exited")
+        # Tensors in the message would be moved to shared memory by torch.multiprocessing
+        self._send((kind, request_id, *args))
+        return request_id, queue
+
+    def _send(self, message: tuple):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def _receive(self):
+        """Delivers the replies to their requests until the pipe closes or a reply cannot be read
+        (e.g. it fails to unpickle). The process is then marked dead, so that the next request
+        starts a new one, and the requests in flight fail."""
+
+        while True:
+            try:
+                request_id, kind, value = self.conn.recv()
+            except (EOFError, OSError):
+                error = RuntimeError(f"The {self.model_name} runner process exited")
+                break
+            except Exception as e:
+                # The pipe is out of sync with the process, which can no longer be used
+                error = RuntimeError(f"Could not read a reply of the {self.model_name} runner: {e}")
+                self.process.terminate()
+                break
+
+            pending = self._pending.get(request_id)
+            if pending is not None:
+                loop, queue = pending
+                loop.call_soon_threadsafe(queue.put_nowait, (kind, value))
+
+        self._dead = True
+        if not self._closed:
+            logger.warning(str(error))
+        for loop, queue in list(self._pending.values()):
+            loop.call_soon_threadsafe(queue.put_nowait, ("error", error))
+
+
+class ProcessRunnerBackend(RunnerBackend):
+    """
+    Runs each model in its own spawned process, started on the model's first request and
+    restarted if it exits. Each process has its own torch thread pool
+    (config.PROCESS_RUNNER_TORCH_THREADS) and serves requests with a LocalRunnerBackend, so a
+    multi-core host can run several models in parallel without Modal.
+
+    Requests and results are pickled over a pipe with torch.multiprocessing, which passes any
+    tensors through shared memory instead of copying them.
+    """
+
+    def __init__(self):
+        self._processes: dict[str, _RunnerProcess] = {}
+
+    async def close(self):
+        for process in self._processes.values():
+            process.close()
+
+    async def run(self, model_name: str, method: str, request: BaseModel) -> BaseModel:
+        return await self._process(model_name).run(method, request)
+
+    async def stream(
+        self, model_name: str, method: str, request: BaseModel
+    ) -> AsyncIterator[BaseModel]:
+        return await self._process(model_name).stream(method, request)
+
+    async def model_states(self) -> dict[str, ModelManagerState]:
+        processes = {
+            model_name: process
+            for model_name, process in self._processes.items()
+            if process.is_alive()
+        }
+        states = await asyncio.gather(
+            *(process.manager_state() for process in processes.values()), return_exceptions=True
+        )
+
+        model_states = {}
+        for model_name, state in zip(processes, states):
+            if isinstance(state, Exception):
+                logger.warning(f"Could not get the state of the {model_name} runner: {state}")
+                continue
+            model_states[model_name] = state
+        return model_states
+
+    def _process(self, model_name: str) -> _RunnerProcess:
+        process = self._processes.get(model_name)
+        if process is None or not process.is_alive():
+            if process is not None:
+                # Reaps the exited process, or stops one whose pipe failed
+                process.process.terminate()
+                process.conn.close()
+            logger.info(f"Starting a runner process for {model_name}")
+            process = self._processes[model_name] = _RunnerProcess(model_name)
+        return process
@@ -8,4 +8,86 @@ MODAL_WORKSPACE_NAME = os.environ.get("MODAL_WORKSPACE_NAME", "WORKSPACE_NAME_NO
 
 USE_MODAL = os.environ.get("USE_MODAL", "False") == "True"
 
+# Where the routers run models: "modal", "local" (in the API process) or "process" (one local
+# process per model, each with PROCESS_RUNNER_TORCH_THREADS torch threads; 0 keeps torch's default)
+RUNNER_BACKEND = os.environ.get("RUNNER_BACKEND", "modal" if USE_MODAL else "local")
+PROCESS_RUNNER_TORCH_THREADS = int(os.environ.get("PROCESS_RUNNER_TORCH_THREADS", "0"))
+
+# Requests in flight per model on Modal, and how long a request may take (0 for no limit)
+MODAL_MAX_CONCURRENT_REQUESTS = int(os.environ.get("MODAL_MAX_CONCURRENT_REQUESTS", "8"))
+MODAL_REQUEST_TIMEOUT_SECONDS = float(os.environ.get("MODAL_REQUEST_TIMEOUT_SECONDS", "300"))
+
 HF_TOKEN = os.environ.get("HF_TOKEN", "HF_TOKEN_NOT_SET")
+
+# Stage timers, counters and histograms served at /metrics and in Server-Timing headers
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "True") == "True"
+
+# Upper bound on the memory used by a block of logits when unembedding the logit lens. The
+# vocabulary is processed in chunks that fit in this budget.
+LOGITLENS_MEMORY_BUDGET_MB = int(os.environ.get("LOGITLENS_MEMORY_BUDGET_MB", "512"))
+
+# Maximum number of (padded) tokens run through the model at once by the batch logit lens
+LOGITLENS_BATCH_TOKEN_BUDGET = int(os.environ.get("LOGITLENS_BATCH_TOKEN_BUDGET", "8192"))
+
+# Cache of logit lens / steering responses. The disk tier is disabled when RESULT_CACHE_DIR is
+# empty. Bump RESULT_CACHE_VERSION to invalidate cached results, e.g. after changing a model.
+RESULT_CACHE_MAX_MB = int(os.environ.get("RESULT_CACHE_MAX_MB", "256"))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_MAX_MB = int(os.environ.get("RESULT_CACHE_DISK_MAX_MB", "2048"))
+RESULT_CACHE_VERSION = os.environ.get("RESULT_CACHE_VERSION", "v1")
+
+# Activation sessions (see services/sessions.py) kept per process: the least recently used are
+# dropped beyond SESSION_MEMORY_BUDGET_MB, and any session after SESSION_TTL_SECONDS without use
+SESSION_MEMORY_BUDGET_MB = int(os.environ.get("SESSION_MEMORY_BUDGET_MB", "1024"))
+SESSION_TTL_SECONDS = float(os.environ.get("SESSION_TTL_SECONDS", "900"))
+
+# Maximum number of steering configurations generated together as one batch by /steering/sweep
+STEERING_SWEEP_MAX_BATCH_SIZE = int(os.environ.get("STEERING_SWEEP_MAX_BATCH_SIZE", "16"))
+
+# Registry of calculated steering vectors. On Modal this directory is a shared volume.
+STEERING_VECTOR_DIR = os.environ.get("STEERING_VECTOR_DIR", "steering_vectors")
+STEERING_VECTOR_DTYPE = os.environ.get("STEERING_VECTOR_DTYPE", "float32")
+# Number of steering vector sets kept on the model device
+STEERING_VECTOR_CACHE_SIZE = int(os.environ.get("STEERING_VECTOR_CACHE_SIZE", "32"))
+
+# Maximum number of (padded) tokens run through the model at once when calculating steering vectors
+STEERING_BATCH_TOKEN_BUDGET = int(os.environ.get("STEERING_BATCH_TOKEN_BUDGET", "8192"))
+
+# Per-model store of prompt activations reused across steering vector calculations, disabled unless
+# set. It grows with every new prompt (d_model floats per prompt and layer) and is never pruned. On
+# Modal this directory is a shared volume.
+ACTIVATION_STORE_DIR = os.environ.get("ACTIVATION_STORE_DIR", "")
+
+# Where torch profiler captures of requests with profile set are written (empty disables them). At
+# most one capture per PROFILE_MIN_INTERVAL_SECONDS per process; PROFILE_TOP_OPS rows are kept in
+# the top ops table. On Modal this directory is a shared volume.
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_MIN_INTERVAL_SECONDS = float(os.environ.get("PROFILE_MIN_INTERVAL_SECONDS", "60"))
+PROFILE_TOP_OPS = int(os.environ.get("PROFILE_TOP_OPS", "30"))
+
+# Locally loaded models are unloaded, least recently used first, to stay within this memory budget
+# and after being idle for this long. 0 disables the budget / idle unloading.
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get("MODEL_MEMORY_BUDGET_MB", "0"))
+MODEL_IDLE_TTL_SECONDS = int(os.environ.get("MODEL_IDLE_TTL_SECONDS", "0"))
+
+# Local inference workers (one per model). Logit lens requests with the same options arriving within
+# the window are batched together, and requests beyond the maximum queue depth are rejected.
+WORKER_BATCH_WINDOW_MS = int(os.environ.get("WORKER_BATCH_WINDOW_MS", "5"))
+WORKER_MAX_BATCH_SIZE = int(os.environ.get("WORKER_MAX_BATCH_SIZE", "16"))
+WORKER_MAX_QUEUE_DEPTH = int(os.environ.get("WORKER_MAX_QUEUE_DEPTH", "64"))
+# Streamed items produced but not yet read by the client, beyond which a stream pauses
+WORKER_STREAM_BUFFER = int(os.environ.get("WORKER_STREAM_BUFFER", "2"))
+
+# Converted TransformerLens weights of locally loaded models, memory-mapped on later loads instead of
+# converting the HF checkpoint again. Disabled unless set, as it takes as much disk as each model in
+# each precision it is loaded in (about 27 GB for llama-2-7b-chat in fp32).
+WEIGHTS_CACHE_DIR = os.environ.get("WEIGHTS_CACHE_DIR", "")
+
+# Precision of loaded models: fp32, bf16 or int8 (dynamic quantization of the MLPs, CPU only, fp32
+# on a GPU). MODEL_PRECISIONS overrides it per model, e.g. "llama-2-7b-chat=int8,gemma-2-2b-it=bf16".
+# Applies to every runner backend; the Modal runners get both settings at deploy time. Cached
+# results and stored activations are kept separately per precision.
+MODEL_PRECISION = os.environ.get("MODEL_PRECISION", "fp32")
+MODEL_PRECISIONS = dict(
+    entry.split("=") for entry in os.environ.get("MODEL_PRECISIONS", "").split(",") if entry
+)
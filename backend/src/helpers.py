@@ -1,10 +1,18 @@
 import logging
 from datetime import datetime, timezone
-from transformer_lens import HookedTransformer, utils
-from src.state import loaded_models, model_expirations
+from typing import AsyncIterator, TypeVar
+from fastapi import Request
+from src.state import model_expirations
 
 logger = logging.getLogger(__name__)
 
+ItemT = TypeVar("ItemT")
+
+
+class InvalidRequest(ValueError):
+    """Raised by the services for a request that cannot be run as sent, e.g. an index out of range
+    for the model. Returned to the client as a 422."""
+
 
 def update_model_expiration(model_name: str) -> str:
     """Update the model's expiration timestamp to the current UTC time.
@@ -25,28 +33,69 @@ def update_model_expiration(model_name: str) -> str:
     return timestamp
 
 
-def load_model(model_name: str):
-    """Loads the specified model. On modal, this effectively just calls the model.from_pretrained method.
+def profile_requested(http_request: Request, profile: bool = False) -> bool:
+    """FastAPI dependency telling whether a request asked to be profiled, with ?profile=true or an
+    X-Profile: 1 header. See src/profiling.py.
+    """
+
+    return profile or http_request.headers.get("x-profile", "").lower() in ("1", "true")
+
+
+async def prefetch_first(stream: AsyncIterator[ItemT]) -> AsyncIterator[ItemT]:
+    """Waits for the first item of a runner stream, so that a request the service rejects (e.g. an
+    index out of range) fails with its error status before a streaming response has sent its
+    headers.
+
+    Returns:
+        An iterator over all the items of the stream, which closes the stream when it is closed
+    """
+
+    try:
+        first = [await anext(stream)]
+    except StopAsyncIteration:
+        first = []
+    except BaseException:
+        await stream.aclose()
+        raise
+
+    async def items():
+        try:
+            for item in first:
+                yield item
+            async for item in stream:
+                yield item
+        finally:
+            await stream.aclose()
+
+    return items()
+
+
+def bucket_by_length(lengths: list[int], token_budget: int) -> list[list[int]]:
+    """Groups sequences into batches of similar length so that little compute is spent on padding.
+
+    Sequences are sorted by length and batches are filled until the padded size
+    (batch size * longest sequence) would exceed the token budget. A sequence longer than the
+    budget gets a batch of its own.
 
     Args:
-        model_name: The name of the model to load.
+        lengths: The token length of each sequence.
+        token_budget: The maximum number of padded tokens per batch.
 
     Returns:
-        The loaded model.
+        A list of batches, each a list of indices into lengths.
     """
 
-    if model_name in loaded_models.keys():
-        logger.info(f"Model {model_name} already loaded.")
-        return loaded_models[model_name]
+    batches: list[list[int]] = []
+    batch: list[int] = []
 
-    logger.info(f"Loading model {model_name}...")
-    device = utils.get_device()
-    model = HookedTransformer.from_pretrained(
-        model_name, device=device, default_prepend_bos=False
-    )
+    for idx in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Sorted ascending, so the current sequence is the longest in the batch
+        if batch and (len(batch) + 1) * lengths[idx] > token_budget:
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
 
-    loaded_models[model_name] = model
-    update_model_expiration(model_name)
+    if batch:
+        batches.append(batch)
 
-    logger.info(f"Model {model_name} successfully loaded!")
-    return model
+    return batches
@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Iterator, TypeVar
+from transformer_lens import HookedTransformer
+import src.config as config
+from src.metrics import current_timings, recording
+from src.model_manager import load_model
+from src.schemas import (
+    LogitLensBatchRequest,
+    LogitLensRequest,
+    LogitLensResponse,
+    WorkerState,
+)
+from src.services.logitlens import logitlens, logitlens_batch
+
+logger = logging.getLogger(__name__)
+
+ResultT = TypeVar("ResultT")
+
+
+class WorkerBusy(Exception):
+    """Raised when a request is submitted to a worker whose queue is full."""
+
+    def __init__(self, model_name: str, queue_depth: int):
+        super().__init__(f"The {model_name} worker is busy ({queue_depth} requests queued)")
+        self.model_name = model_name
+        self.queue_depth = queue_depth
+
+    def __reduce__(self):
+        # Lets the exception cross process boundaries, see backends/process.py
+        return (WorkerBusy, (self.model_name, self.queue_depth))
+
+
+class _Job:
+    """A unit of work for an InferenceWorker, with its result delivered to the submitting event
+    loop.
+
+    Jobs are one of:
+        "call": fn(model) is run and its result resolves future
+        "iter": fn(model) returns an iterator that is advanced one item per turn, each item being
+            put on items. Once config.WORKER_STREAM_BUFFER items are unread the job is parked
+            (out of the queue) until the consumer reads one.
+        "logitlens": request is run as part of a micro-batch and resolves future
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        kind: str,
+        fn: Callable[[HookedTransformer], Any] = None,
+        request: LogitLensRequest = None,
+    ):
+        self.loop = loop
+        self.kind = kind
+        self.fn = fn
+        self.request = request
+        # Stages run for this job are reported in the Server-Timing header of its request
+        self.timings = current_timings()
+
+        self.future: asyncio.Future = loop.create_future()
+        self.items: asyncio.Queue = asyncio.Queue()
+        self.iterator: Iterator | None = None
+        self.cancelled = False
+        # Items put but not yet read, and whether the job waits for the consumer to read one.
+        # Guarded by the worker's condition.
+        self.unread = 0
+        self.parked = False
+
+        # Only logit lens requests with the same options can share a batch
+        self.batch_key = (
+            request.model_dump_json(exclude={"input"}) if request is not None else None
+        )
+
+    def resolve(self, result: Any = None, error: BaseException | None = None):
+        def set_result():
+            if self.future.done():
+                return
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+
+        self.loop.call_soon_threadsafe(set_result)
+
+    def put(self, kind: str, value: Any = None):
+        self.loop.call_soon_threadsafe(self.items.put_nowait, (kind, value))
+
+
+class InferenceWorker:
+    """
+    Runs all local inference for one model on a dedicated thread.
+
+    Requests are queued and run one at a time, so the model's hooks only ever belong to a single
+    request. Logit lens requests with the same options that arrive within
+    config.WORKER_BATCH_WINDOW_MS of each other are run as one padded batch. Streaming requests are
+    advanced one item per turn, taking turns with the other queued requests, and pause while their
+    client has config.WORKER_STREAM_BUFFER items left to read. Submitting to a worker
+    whose queue holds config.WORKER_MAX_QUEUE_DEPTH requests raises WorkerBusy.
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+        self._jobs: deque[_Job] = deque()
+        self._condition = threading.Condition()
+        self._running = False
+
+        self._thread = threading.Thread(
+            target=self._run, name=f"inference-{model_name}", daemon=True
+        )
+        self._thread.start()
+
+    async def run(self, fn: Callable[[HookedTransformer], ResultT]) -> ResultT:
+        """Runs fn(model) on the worker and returns its result."""
+
+        job = self._submit(_Job(asyncio.get_running_loop(), "call", fn=fn))
+        return await job.future
+
+    async def logitlens(self, request: LogitLensRequest) -> LogitLensResponse:
+        """Runs the logit lens on the worker, batched with other queued logit lens requests."""
+
+        job = self._submit(_Job(asyncio.get_running_loop(), "logitlens", request=request))
+        return await job.future
+
+    def stream(
+        self, fn: Callable[[HookedTransformer], Iterator[ResultT]]
+    ) -> AsyncIterator[ResultT]:
+        """Iterates fn(model) on the worker. The request is queued immediately (raising WorkerBusy
+        if the queue is full), and closing the returned iterator stops the underlying one.
+        """
+
+        job = self._submit(_Job(asyncio.get_running_loop(), "iter", fn=fn))
+        return self._iterate(job)
+
+    def state(self) -> WorkerState:
+        with self._condition:
+            return WorkerState(
+                queue_depth=len(self._jobs),
+                max_queue_depth=config.WORKER_MAX_QUEUE_DEPTH,
+                running=self._running,
+            )
+
+    async def _iterate(self, job: _Job) -> AsyncIterator:
+        try:
+            while True:
+                kind, value = await job.items.get()
+                if kind == "done":
+                    return
+                if kind == "error":
+                    raise value
+
+                with self._condition:
+                    job.unread -= 1
+                    self._resume(job)
+                yield value
+        finally:
+            # The worker closes the iterator on its next turn
+            with self._condition:
+                job.cancelled = True
+                self._resume(job)
+
+    def _resume(self, job: _Job):
+        """Requeues a parked stream job. Must be called with the condition held."""
+
+        if job.parked:
+            job.parked = False
+            self._jobs.append(job)
+            self._condition.notify()
+
+    def _submit(self, job: _Job) -> _Job:
+        with self._condition:
+            if len(self._jobs) >= config.WORKER_MAX_QUEUE_DEPTH:
+                raise WorkerBusy(self.model_name, len(self._jobs))
+            self._jobs.append(job)
+            self._condition.notify()
+        return job
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._jobs:
+                    self._running = False
+                    self._condition.wait()
+                job = self._jobs.popleft()
+                self._running = True
+
+            if job.kind == "iter":
+                self._step(job)
+                continue
+
+            batch = self._collect_batch(job) if job.kind == "logitlens" else [job]
+            try:
+                with recording(*(timings for batch_job in batch for timings in batch_job.timings)):
+                    if job.kind == "logitlens":
+                        self._run_logitlens(batch)
+                    else:
+                        job.resolve(job.fn(load_model(self.model_name)))
+            except Exception as e:
+                for batch_job in batch:
+                    batch_job.resolve(error=e)
+
+    def _collect_batch(self, first: _Job) -> list[_Job]:
+        """Takes the queued logit lens jobs that can share a batch with first, waiting up to the
+        batch window for more to arrive."""
+
+        batch = [first]
+        if first.request.profile:
+            # A profiled request runs alone so that its capture only covers itself
+            return batch
+        deadline = time.monotonic() + config.WORKER_BATCH_WINDOW_MS / 1000
+
+        with self._condition:
+            while True:
+                for job in list(self._jobs):
+                    if len(batch) >= config.WORKER_MAX_BATCH_SIZE:
+                        break
+                    if job.batch_key == first.batch_key:
+                        self._jobs.remove(job)
+                        batch.append(job)
+
+                remaining = deadline - time.monotonic()
+                if len(batch) >= config.WORKER_MAX_BATCH_SIZE or remaining <= 0:
+                    return batch
+                self._condition.wait(remaining)
+
+    def _run_logitlens(self, batch: list[_Job]):
+        model = load_model(self.model_name)
+
+        if len(batch) == 1:
+            batch[0].resolve(logitlens(batch[0].request, model))
+            return
+
+        logger.info(f"Running {len(batch)} logit lens requests as one batch")
+        first = batch[0].request
+        request = LogitLensBatchRequest(
+            **first.model_dump(exclude={"input"}),
+            inputs=[job.request.input for job in batch],
+        )
+        try:
+            responses = logitlens_batch(request, model)
+        except Exception:
+            # Run the requests separately so that each error reaches its own request
+            for job in batch:
+                try:
+                    job.resolve(logitlens(job.request, model))
+                except Exception as e:
+                    job.resolve(error=e)
+            return
+
+        for job, response in zip(batch, responses):
+            job.resolve(response)
+
+    def _step(self, job: _Job):
+        """Advances a streaming job by one item and requeues it behind the other jobs, or parks it
+        when its consumer is config.WORKER_STREAM_BUFFER items behind."""
+
+        if job.cancelled:
+            if job.iterator is not None:
+                job.iterator.close()
+            return
+
+        try:
+            if job.iterator is None:
+                job.iterator = job.fn(load_model(self.model_name))
+            item = next(job.iterator)
+        except StopIteration:
+            job.put("done")
+            return
+        except Exception as e:
+            job.put("error", e)
+            return
+
+        job.put("item", item)
+        with self._condition:
+            job.unread += 1
+            if job.cancelled or job.unread < config.WORKER_STREAM_BUFFER:
+                self._jobs.append(job)
+            else:
+                job.parked = True
+
+
+_workers: dict[str, InferenceWorker] = {}
+_workers_lock = threading.Lock()
+
+
+def get_worker(model_name: str) -> InferenceWorker:
+    """Returns the inference worker of a model, starting it on first use."""
+
+    with _workers_lock:
+        if model_name not in _workers:
+            _workers[model_name] = InferenceWorker(model_name)
+        return _workers[model_name]
+
+
+def worker_states() -> dict[str, WorkerState]:
+    """Returns the queue state of every started worker."""
+
+    with _workers_lock:
+        workers = dict(_workers)
+    return {model_name: worker.state() for model_name, worker in workers.items()}
@@ -1,11 +1,22 @@
+import asyncio
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
 import torch as t
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 import src.config as config
 import src.state as state
+from src.backends import RunnerTimeout, get_runner_backend
+from src.helpers import InvalidRequest
+from src.inference_worker import WorkerBusy, worker_states
+from src.metrics import MetricsMiddleware, TimedRoute, metrics
+from src.model_manager import model_manager
+from src.services.sessions import SessionNotFound
+from src.services.steering_registry import SteeringVectorNotFound
 from src.routers.logitlens import router as logitlens_router
+from src.routers.sessions import router as sessions_router
 from src.routers.steering import router as steering_router
 
 logging.basicConfig(
@@ -15,18 +26,37 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+async def evict_idle_models():
+    """Periodically unloads local models that have been idle for longer than the idle TTL."""
+
+    while True:
+        await asyncio.sleep(config.MODEL_IDLE_TTL_SECONDS / 4)
+        await run_in_threadpool(model_manager.evict_idle)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    logger.info(f"Using modal: {config.USE_MODAL}")
+    logger.info(f"Using modal: {config.USE_MODAL}, runner backend: {config.RUNNER_BACKEND}")
 
     if not config.USE_MODAL and not t.cuda.is_available():
         logger.warning("CUDA is not available! Using CPU instead.")
 
+    eviction_task = None
+    if not config.USE_MODAL and config.MODEL_IDLE_TTL_SECONDS > 0:
+        eviction_task = asyncio.create_task(evict_idle_models())
+
+    backend = get_runner_backend()
+    await backend.start()
+
     yield
-    # Shutdown logic (optional)
+
+    if eviction_task:
+        eviction_task.cancel()
+    await backend.close()
 
 
 app = FastAPI(lifespan=lifespan)
+app.router.route_class = TimedRoute
 
 app.add_middleware(
     CORSMiddleware,
@@ -36,8 +66,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(logitlens_router)
 app.include_router(steering_router)
+app.include_router(sessions_router)
+
+
+@app.exception_handler(WorkerBusy)
+async def worker_busy_handler(request: Request, exc: WorkerBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "queue_depth": exc.queue_depth},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(InvalidRequest)
+async def invalid_request_handler(request: Request, exc: InvalidRequest):
+    return JSONResponse(status_code=422, content={"detail": str(exc)})
+
+
+@app.exception_handler(RunnerTimeout)
+async def runner_timeout_handler(request: Request, exc: RunnerTimeout):
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+
+@app.exception_handler(SessionNotFound)
+async def session_not_found_handler(request: Request, exc: SessionNotFound):
+    return JSONResponse(status_code=404, content={"detail": str(exc)})
+
+
+@app.exception_handler(SteeringVectorNotFound)
+async def steering_vector_not_found_handler(request: Request, exc: SteeringVectorNotFound):
+    return JSONResponse(status_code=404, content={"detail": str(exc)})
 
 
 @app.get("/")
@@ -57,10 +119,54 @@ async def list_models():
 
 
 @app.get("/loaded_models")
-async def list_loaded_models():
+async def list_loaded_models(details: bool = False):
     """Lists the models that have been loaded on the server.
 
+    Args:
+        details: Return the state of the model manager instead: the size and last use of each
+            loaded model, the models being loaded and the memory budget. With the process backend,
+            the state of each runner process keyed by its model.
+
     Returns:
-        A dictionary with the model name as the key and the timestamp of when the model was loaded as the value.
+        A dictionary with the model name as the key and the timestamp of when the model was last used as the value.
     """
-    return state.model_expirations
+    if config.RUNNER_BACKEND == "local":
+        if details:
+            return model_manager.state()
+
+        # A request finishing after its model was unloaded still updates the timestamp
+        return {
+            model_name: timestamp
+            for model_name, timestamp in state.model_expirations.items()
+            if model_name in state.loaded_models
+        }
+
+    # The models are loaded by the backend's runners, not in this process
+    model_states = await get_runner_backend().model_states()
+    if details:
+        if model_states is None:
+            raise HTTPException(
+                status_code=501,
+                detail=f"Model details are not available with the {config.RUNNER_BACKEND} backend",
+            )
+        return model_states
+
+    if model_states is None:
+        return state.model_expirations
+    return {
+        model_name: timestamp
+        for model_name, timestamp in state.model_expirations.items()
+        if model_name in model_states and model_name in model_states[model_name].models
+    }
+
+
+@app.get("/workers")
+async def list_workers():
+    """Lists the queue depth of the local inference worker of each model that has been used."""
+    return worker_states()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Serves the latency, throughput and request metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,348 @@
+import contextvars
+import functools
+import inspect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+import torch as t
+from fastapi.routing import APIRoute
+import src.config as config
+
+# Upper bounds of the histogram buckets of durations (seconds) and of throughputs (per second)
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATE_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+DESCRIPTIONS = {
+    "stage_duration_seconds": "Time spent in each stage of request handling",
+    "http_requests_total": "HTTP requests by route and status",
+    "http_request_duration_seconds": "Time until the response headers are sent, by route",
+    "model_loads_total": "Models loaded into memory",
+    "generation_tokens_total": "Tokens generated by the decode loop",
+    "generation_seconds_total": "Time spent in decode forward passes",
+    "generation_tokens_per_second": "Decode throughput of each generation",
+    "activation_prompts_total": "Prompts whose activations were extracted",
+    "activation_seconds_total": "Time spent extracting activations",
+    "activation_prompts_per_second": "Activation extraction throughput of each batch",
+}
+
+# The Server-Timing entries of the current request, see recording()
+_timings: contextvars.ContextVar[tuple[list, ...]] = contextvars.ContextVar(
+    "timings", default=()
+)
+# When the endpoint of the current request returned, see TimedRoute
+_endpoint_returned: contextvars.ContextVar[list[float] | None] = contextvars.ContextVar(
+    "endpoint_returned", default=None
+)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Stage:
+    """Times a stage, see Metrics.stage."""
+
+    def __init__(
+        self, metrics: "Metrics", name: str, device: t.device | str | None, labels: dict[str, str]
+    ):
+        self.metrics = metrics
+        self.name = name
+        self.device = t.device(device) if device is not None else None
+        self.labels = labels
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.device is not None and self.device.type == "cuda":
+            t.cuda.synchronize(self.device)
+        self.seconds = time.perf_counter() - self._start
+        self.metrics.record_stage(self.name, self.seconds, **self.labels)
+
+
+class _NoStage:
+    """Stands in for _Stage when metrics are disabled."""
+
+    seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+class Metrics:
+    """
+    A minimal in-process registry of counters and histograms, rendered in the Prometheus text
+    format by /metrics.
+
+    stage() times a block of code into stage_duration_seconds and into the Server-Timing header of
+    the request being handled. When disabled, stage() returns a shared no-op context manager and
+    the other methods return immediately.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters: dict[tuple[str, Labels], float] = {}
+        self._histograms: dict[tuple[str, Labels], _Histogram] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels: str):
+        """Adds value to a counter."""
+
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(
+        self, name: str, value: float, buckets: tuple[float, ...] = DURATION_BUCKETS, **labels: str
+    ):
+        """Adds a value to a histogram."""
+
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = _Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    def stage(
+        self, name: str, device: t.device | str | None = None, **labels: str
+    ) -> _Stage | _NoStage:
+        """Returns a context manager timing a stage. Its seconds attribute holds the duration once
+        the block has run.
+
+        Args:
+            name: The stage name
+            device: For stages launching CUDA kernels, the device to synchronize before the stage
+                ends, so that their run time is not attributed to a later stage
+            labels: Extra labels of the stage_duration_seconds histogram
+        """
+
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name, device, labels)
+
+    def record_stage(self, name: str, seconds: float, **labels: str):
+        """Records a stage timed without stage(), see stage()."""
+
+        if not self.enabled:
+            return
+
+        self.observe("stage_duration_seconds", seconds, stage=name, **labels)
+        for timings in _timings.get():
+            timings.append((name, seconds))
+
+    def record_rate(self, prefix: str, unit: str, count: int, seconds: float):
+        """Records count units processed in seconds, into {prefix}_{unit}_total,
+        {prefix}_seconds_total and the {prefix}_{unit}_per_second histogram."""
+
+        if not self.enabled or count == 0:
+            return
+
+        self.inc(f"{prefix}_{unit}_total", count)
+        self.inc(f"{prefix}_seconds_total", seconds)
+        if seconds > 0:
+            self.observe(f"{prefix}_{unit}_per_second", count / seconds, buckets=RATE_BUCKETS)
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                key: (hist.buckets, list(hist.counts), hist.sum, hist.count)
+                for key, hist in self._histograms.items()
+            }
+
+        lines = []
+        described = set()
+
+        def describe(name: str, kind: str):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {DESCRIPTIONS.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for (name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip((*buckets, math.inf), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == math.inf else str(bound)
+                lines.append(f"{name}_bucket{_format_labels((*labels, ('le', le)))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def current_timings() -> tuple[list, ...]:
+    """Returns the Server-Timing lists of the current request, to record into from another thread
+    with recording()."""
+
+    return _timings.get()
+
+
+@contextmanager
+def recording(*timings: list) -> Iterator[None]:
+    """Records the stages run inside the block into each of the given Server-Timing lists."""
+
+    token = _timings.set(tuple(timings))
+    try:
+        yield
+    finally:
+        _timings.reset(token)
+
+
+def server_timing(timings: list[tuple[str, float]], total_seconds: float) -> str:
+    """Formats stage timings as a Server-Timing header, summing repeated stages."""
+
+    durations: dict[str, float] = {}
+    for name, seconds in timings:
+        durations[name] = durations.get(name, 0.0) + seconds
+    durations["total"] = total_seconds
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations.items())
+
+
+class TimedRoute(APIRoute):
+    """Route class timing FastAPI's serialization of the endpoint's return value into the response
+    (encoding and rendering the JSON) as the "serialize" stage."""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        if inspect.iscoroutinefunction(endpoint):
+            endpoint = self._timed_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    @staticmethod
+    def _timed_endpoint(endpoint: Callable) -> Callable:
+        # functools.wraps keeps the signature FastAPI reads the parameters from
+        @functools.wraps(endpoint)
+        async def timed_endpoint(*args, **kwargs):
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                returned = _endpoint_returned.get()
+                if returned is not None:
+                    returned.append(time.perf_counter())
+
+        return timed_endpoint
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            returned: list[float] = []
+            token = _endpoint_returned.set(returned)
+            try:
+                response = await handler(request)
+            finally:
+                _endpoint_returned.reset(token)
+
+            if returned:
+                metrics.record_stage("serialize", time.perf_counter() - returned[0])
+            return response
+
+        return timed_handler
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting requests and adding a Server-Timing header with the stages timed
+    while the request was handled.
+
+    An exception escaping the app before the response started is answered here with the same 500
+    that Starlette's ServerErrorMiddleware would send, so that it is counted and timed too, and is
+    then re-raised to be logged.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings: list[tuple[str, float]] = []
+        response_started = False
+
+        async def send_with_timing(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+                total = time.perf_counter() - start
+                route = scope.get("route")
+                path = route.path if route is not None else "unmatched"
+                metrics.inc("http_requests_total", path=path, status=str(message["status"]))
+                metrics.observe("http_request_duration_seconds", total, path=path)
+
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(timings, total).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        with recording(timings):
+            try:
+                await self.app(scope, receive, send_with_timing)
+            except Exception:
+                if not response_started:
+                    body = b"Internal Server Error"
+                    await send_with_timing(
+                        {
+                            "type": "http.response.start",
+                            "status": 500,
+                            "headers": [
+                                (b"content-type", b"text/plain; charset=utf-8"),
+                                (b"content-length", str(len(body)).encode()),
+                            ],
+                        }
+                    )
+                    await send_with_timing({"type": "http.response.body", "body": body})
+                raise
+
+
+metrics = Metrics(config.METRICS_ENABLED)
@@ -1,6 +1,15 @@
 import modal
-from src.schemas import RunWithSteeringRequest, SteeringVectorRequest
-from src.services.steering import calculate_steering_vectors, run_with_steering
+from src.schemas import (
+    RunWithSteeringRequest,
+    SteeringSweepRequest,
+    SteeringVectorRequest,
+)
+from src.services.steering import (
+    calculate_steering_vectors,
+    run_with_steering,
+    stream_with_steering,
+    sweep_steering,
+)
 import src.config as config
 
 
@@ -11,17 +20,59 @@ image = (
     .uv_pip_install("fastapi[standard]")
     .uv_pip_install("torch")
     .uv_pip_install("transformer_lens")
-    .env({"HF_TOKEN": config.HF_TOKEN})
+    .uv_pip_install("safetensors")
+    .env(
+        {
+            "HF_TOKEN": config.HF_TOKEN,
+            "STEERING_VECTOR_DIR": "/steering_vectors",
+            "ACTIVATION_STORE_DIR": "/activation_store",
+            "PROFILE_DIR": "/profiles",
+            # The runners load their models in the precision configured for the API, which also
+            # keys its result cache by it
+            "MODEL_PRECISION": config.MODEL_PRECISION,
+            "MODEL_PRECISIONS": ",".join(
+                f"{model_name}={precision}"
+                for model_name, precision in config.MODEL_PRECISIONS.items()
+            ),
+        }
+    )
     .add_local_dir(".", "/root", ignore=["__pycache__", ".git", ".env", ".venv"])
 )
 app_name = config.MODAL_APP_NAME
 app = modal.App(app_name, image=image)
 
+# Shared by all runners so vectors calculated on one container can be used on the others
+steering_vector_volume = modal.Volume.from_name(
+    f"{app_name}-steering-vectors", create_if_missing=True
+)
+activation_store_volume = modal.Volume.from_name(
+    f"{app_name}-activation-store", create_if_missing=True
+)
+# Profiler captures of requests with profile set, e.g. `modal volume get {app_name}-profiles <path>`
+profiles_volume = modal.Volume.from_name(f"{app_name}-profiles", create_if_missing=True)
+
 
 with image.imports():  # import in the global scope so imports can be snapshot
-    from transformer_lens import HookedTransformer, utils
-    from src.services.logitlens import logitlens
-    from src.schemas import LogitLensRequest
+    from transformer_lens import utils
+    from src.services.logitlens import logitlens, logitlens_batch, logitlens_stream
+    from src.schemas import (
+        LogitLensBatchRequest,
+        LogitLensRequest,
+        SessionAttentionRequest,
+        SessionCreateRequest,
+        SessionLensRequest,
+        SessionRequest,
+        SteeringVectorSource,
+    )
+    from src.services.sessions import (
+        create_session,
+        delete_session,
+        session_attention,
+        session_lens,
+        session_norms,
+    )
+    from src.services.steering_registry import has_steering_vectors
+    from src.precision import configured_precision, load_with_precision
 
 snapshot_key = "v1"  # change this to invalidate the snapshot cache
 
@@ -39,25 +90,85 @@ class _BaseModelRunner:
         """
 
         device = utils.get_device()
-        self.model = HookedTransformer.from_pretrained(
-            self.MODEL_NAME, device=device, default_prepend_bos=False
+        self.model = load_with_precision(
+            self.MODEL_NAME, device, configured_precision(self.MODEL_NAME)
         )
 
     @modal.method()
     def generate(self, prompt: str) -> str:
         return self.model.generate(prompt, max_new_tokens=100)
 
+    def commit_profile(self, response):
+        """Commits the profile volume if the response references a capture."""
+
+        if response.profile is not None:
+            profiles_volume.commit()
+        return response
+
     @modal.method()
     def logitlens(self, request: LogitLensRequest):
-        return logitlens(request, self.model)
+        return self.commit_profile(logitlens(request, self.model))
+
+    @modal.method()
+    def logitlens_batch(self, request: LogitLensBatchRequest):
+        return logitlens_batch(request, self.model)
+
+    @modal.method()
+    def logitlens_stream(self, request: LogitLensRequest):
+        yield from logitlens_stream(request, self.model)
+
+    # Sessions live in the memory of the container that created them. Requests for a session that
+    # Modal routes to another container get a 404, and the client recreates the session.
+    @modal.method()
+    def create_session(self, request: SessionCreateRequest):
+        return create_session(request, self.model)
+
+    @modal.method()
+    def session_lens(self, request: SessionLensRequest):
+        return session_lens(request, self.model)
+
+    @modal.method()
+    def session_norms(self, request: SessionRequest):
+        return session_norms(request, self.model)
+
+    @modal.method()
+    def session_attention(self, request: SessionAttentionRequest):
+        return session_attention(request, self.model)
+
+    @modal.method()
+    def delete_session(self, request: SessionRequest):
+        return delete_session(request, self.model)
+
+    def sync_steering_vectors(self, request: SteeringVectorSource):
+        """Reloads the steering vector volume if the requested vectors were saved by another
+        container after this one mounted it."""
+
+        vector_id = request.steering_vector_id
+        if vector_id is not None and not has_steering_vectors(vector_id):
+            steering_vector_volume.reload()
 
     @modal.method()
     def calculate_steering_vectors(self, request: SteeringVectorRequest):
-        return calculate_steering_vectors(request, self.model)
+        activation_store_volume.reload()
+        response = calculate_steering_vectors(request, self.model)
+        steering_vector_volume.commit()
+        activation_store_volume.commit()
+        return self.commit_profile(response)
 
     @modal.method()
     def run_with_steering(self, request: RunWithSteeringRequest):
-        return run_with_steering(request, self.model)
+        self.sync_steering_vectors(request)
+        return self.commit_profile(run_with_steering(request, self.model))
+
+    @modal.method()
+    def stream_with_steering(self, request: RunWithSteeringRequest):
+        self.sync_steering_vectors(request)
+        yield from stream_with_steering(request, self.model)
+
+    @modal.method()
+    def sweep_steering(self, request: SteeringSweepRequest):
+        self.sync_steering_vectors(request)
+        yield from sweep_steering(request, self.model)
 
 
 def build_runner(class_name: str, model_name: str, gpu: str = "T4"):
@@ -72,6 +183,11 @@ def build_runner(class_name: str, model_name: str, gpu: str = "T4"):
     # Apply app.cls to each class independently
     return app.cls(
         gpu=gpu,
+        volumes={
+            "/steering_vectors": steering_vector_volume,
+            "/activation_store": activation_store_volume,
+            "/profiles": profiles_volume,
+        },
         enable_memory_snapshot=True,
         experimental_options={"enable_gpu_snapshot": True},
     )(cls)
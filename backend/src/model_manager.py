@@ -0,0 +1,191 @@
+import gc
+import logging
+import threading
+from datetime import datetime, timezone
+import torch as t
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from transformer_lens import HookedTransformer, utils
+import src.config as config
+from src.helpers import update_model_expiration
+from src.metrics import metrics
+from src.schemas import LoadedModelInfo, ModelManagerState
+from src.state import loaded_models, model_expirations, vocab_strings
+from src.precision import configured_precision, load_with_precision, model_precision
+
+logger = logging.getLogger(__name__)
+
+
+def model_bytes(model: HookedTransformer) -> int:
+    """Returns the memory taken by the parameters, buffers and quantized weights of a model."""
+
+    tensors = list(model.parameters()) + list(model.buffers())
+    tensors += [
+        module.weight()
+        for module in model.modules()
+        if isinstance(module, DynamicQuantizedLinear)
+    ]
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class ModelManager:
+    """
+    Keeps the locally loaded models (state.loaded_models) within a memory budget.
+
+    The last use of each model is its timestamp in state.model_expirations. When a model does not
+    fit, the least recently used models are unloaded first, and models idle for longer than the
+    idle TTL are unloaded by evict_idle(). Concurrent loads of the same model share one load.
+    """
+
+    def __init__(self, max_bytes: int, idle_ttl_seconds: int):
+        self.max_bytes = max_bytes
+        self.idle_ttl_seconds = idle_ttl_seconds
+
+        self._lock = threading.Lock()
+        # Set once the in-progress load of a model has finished (or failed)
+        self._loading: dict[str, threading.Event] = {}
+        # Size of every model loaded so far, used to make room before loading it again
+        self._sizes: dict[str, int] = {}
+
+    def get(self, model_name: str) -> HookedTransformer:
+        """Returns the model, loading it if needed.
+
+        Args:
+            model_name: The name of the model
+
+        Returns:
+            The loaded model
+        """
+
+        self.evict_idle()
+
+        while True:
+            with self._lock:
+                if model_name in loaded_models:
+                    logger.info(f"Model {model_name} already loaded.")
+                    return loaded_models[model_name]
+
+                loading = self._loading.get(model_name)
+                if loading is None:
+                    loading = self._loading[model_name] = threading.Event()
+                    break
+
+            logger.info(f"Waiting for the in-progress load of {model_name}")
+            loading.wait()
+
+        try:
+            with self._lock:
+                self._make_room(self._sizes.get(model_name, 0))
+
+            logger.info(f"Loading model {model_name}...")
+            precision = configured_precision(model_name)
+            with metrics.stage("load_model"):
+                model = load_with_precision(model_name, utils.get_device(), precision)
+            metrics.inc("model_loads_total", model=model_name, precision=precision)
+
+            with self._lock:
+                self._sizes[model_name] = model_bytes(model)
+                loaded_models[model_name] = model
+                update_model_expiration(model_name)
+                # The size was only an estimate if the model had not been loaded before
+                self._make_room(0, keep=model_name)
+        finally:
+            with self._lock:
+                self._loading.pop(model_name).set()
+
+        logger.info(
+            f"Model {model_name} successfully loaded in {precision}! "
+            f"({self._sizes[model_name] / 2**20:.0f} MB)"
+        )
+        return model
+
+    def evict_idle(self):
+        """Unloads the models that have not been used for longer than the idle TTL."""
+
+        if self.idle_ttl_seconds <= 0:
+            return
+
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            for model_name in list(loaded_models.keys()):
+                idle = (now - self._last_used(model_name)).total_seconds()
+                if idle > self.idle_ttl_seconds:
+                    logger.info(f"Model {model_name} idle for {idle:.0f}s")
+                    self._unload(model_name)
+
+    def state(self) -> ModelManagerState:
+        """Returns the loaded models and the memory budget."""
+
+        with self._lock:
+            return ModelManagerState(
+                memory_budget_mb=self.max_bytes / 2**20,
+                used_mb=self._used_bytes() / 2**20,
+                idle_ttl_seconds=self.idle_ttl_seconds,
+                models={
+                    model_name: LoadedModelInfo(
+                        last_used=model_expirations[model_name],
+                        size_mb=self._size(model_name) / 2**20,
+                        precision=model_precision(loaded_models[model_name]),
+                    )
+                    for model_name in loaded_models.keys()
+                },
+                loading=list(self._loading.keys()),
+            )
+
+    def _last_used(self, model_name: str) -> datetime:
+        return datetime.fromisoformat(model_expirations[model_name])
+
+    def _size(self, model_name: str) -> int:
+        if model_name not in self._sizes:
+            self._sizes[model_name] = model_bytes(loaded_models[model_name])
+        return self._sizes[model_name]
+
+    def _used_bytes(self) -> int:
+        return sum(self._size(model_name) for model_name in loaded_models.keys())
+
+    def _make_room(self, incoming_bytes: int, keep: str | None = None):
+        """Unloads least recently used models until incoming_bytes more fit in the budget. Must be
+        called with the lock held."""
+
+        if self.max_bytes <= 0:
+            return
+
+        while self._used_bytes() + incoming_bytes > self.max_bytes:
+            candidates = [model_name for model_name in loaded_models.keys() if model_name != keep]
+            if not candidates:
+                logger.warning(f"Loaded models exceed the memory budget of {self.max_bytes} bytes")
+                return
+            self._unload(min(candidates, key=self._last_used))
+
+    def _unload(self, model_name: str):
+        """Drops the references held to a model. Must be called with the lock held."""
+
+        logger.info(f"Unloading model {model_name}")
+        model = loaded_models.pop(model_name)
+        model_expirations.pop(model_name, None)
+        # Keyed like get_vocab_strings, by the TransformerLens name rather than the API name
+        vocab_strings.pop(model.cfg.model_name, None)
+        del model
+
+        # Requests still running on the model keep it alive until they finish
+        gc.collect()
+        if t.cuda.is_available():
+            t.cuda.empty_cache()
+
+
+model_manager = ModelManager(
+    max_bytes=config.MODEL_MEMORY_BUDGET_MB * 2**20,
+    idle_ttl_seconds=config.MODEL_IDLE_TTL_SECONDS,
+)
+
+
+def load_model(model_name: str) -> HookedTransformer:
+    """Loads the specified model, or returns it if it is already loaded, see ModelManager.
+
+    Args:
+        model_name: The name of the model to load.
+
+    Returns:
+        The loaded model.
+    """
+
+    return model_manager.get(model_name)
@@ -0,0 +1,121 @@
+import logging
+import types
+import torch as t
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from torch.ao.quantization import quantize_dynamic
+from transformer_lens import HookedTransformer
+from transformer_lens.components import MLP, GatedMLP
+import src.config as config
+from src.weights_cache import load_pretrained
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+
+def configured_precision(model_name: str) -> str:
+    """Returns the precision a model is loaded in: its entry in config.MODEL_PRECISIONS, or
+    config.MODEL_PRECISION."""
+
+    precision = config.MODEL_PRECISIONS.get(model_name, config.MODEL_PRECISION)
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision} for {model_name}, expected {PRECISIONS}")
+    return precision
+
+
+def model_precision(model: HookedTransformer) -> str:
+    """Returns the precision of a loaded model."""
+
+    if any(isinstance(module, DynamicQuantizedLinear) for module in model.modules()):
+        return "int8"
+    return {t.bfloat16: "bf16", t.float16: "fp16"}.get(model.cfg.dtype, "fp32")
+
+
+def load_with_precision(
+    model_name: str, device: t.device | str, precision: str
+) -> HookedTransformer:
+    """Loads a pretrained model in the given precision.
+
+    "fp32" and "bf16" load the weights in that dtype. "int8" loads fp32 weights and applies int8
+    dynamic quantization to the MLP projections (see quantize_mlps), which needs a CPU device;
+    elsewhere the model is loaded in fp32 instead.
+
+    Args:
+        model_name: The name of the model to load
+        device: The device to place the model on
+        precision: One of PRECISIONS
+
+    Returns:
+        The loaded model
+    """
+
+    if precision == "bf16":
+        return load_pretrained(model_name, device, t.bfloat16)
+
+    model = load_pretrained(model_name, device, t.float32)
+
+    if precision == "int8":
+        if t.device(device).type != "cpu":
+            logger.warning(f"int8 needs a CPU device, loading {model_name} in fp32 on {device}")
+        else:
+            quantize_mlps(model)
+
+    return model
+
+
+def _quantize_linear(weight: t.Tensor) -> DynamicQuantizedLinear:
+    """Returns an int8 dynamically quantized linear layer computing x @ weight."""
+
+    linear = t.nn.Linear(*weight.shape, bias=False)
+    linear.weight = t.nn.Parameter(weight.detach().T.contiguous(), requires_grad=False)
+    # quantize_dynamic swaps child modules, so the layer is wrapped
+    return quantize_dynamic(t.nn.Sequential(linear), {t.nn.Linear}, dtype=t.qint8)[0]
+
+
+def _quantized_mlp_forward(self: MLP, x: t.Tensor) -> t.Tensor:
+    pre_act = self.hook_pre(self.W_in_int8(x) + self.b_in)
+    post_act = self.hook_post(self.act_fn(pre_act))
+    return self.W_out_int8(post_act) + self.b_out
+
+
+def _quantized_gated_mlp_forward(self: GatedMLP, x: t.Tensor) -> t.Tensor:
+    pre_act = self.hook_pre(self.W_gate_int8(x))
+    pre_linear = self.hook_pre_linear(self.W_in_int8(x))
+    post_act = self.hook_post(self.act_fn(pre_act) * pre_linear + self.b_in)
+    return self.W_out_int8(post_act) + self.b_out
+
+
+def quantize_mlps(model: HookedTransformer):
+    """Replaces the weight matrices of every MLP with int8 dynamically quantized linear layers, in
+    place. The MLPs hold most of the parameters; attention, embeddings and the unembedding (read
+    directly by the logit lens) stay in fp32. Hook points are unchanged.
+
+    TransformerLens multiplies its weights directly rather than through nn.Linear modules, so the
+    MLP forward is replaced by an equivalent one calling the quantized layers.
+    """
+
+    if model.cfg.is_layer_norm_activation():
+        logger.warning("MLPs with a layer norm activation are not quantized")
+        return
+
+    # Every block is checked before any is changed, so the model is never partly quantized
+    unsupported = {
+        type(block.mlp).__name__
+        for block in model.blocks
+        if type(block.mlp) not in (MLP, GatedMLP)
+    }
+    if unsupported:
+        logger.warning(f"{', '.join(sorted(unsupported))} layers are not quantized")
+        return
+
+    for block in model.blocks:
+        mlp = block.mlp
+        if type(mlp) is MLP:
+            names, forward = ("W_in", "W_out"), _quantized_mlp_forward
+        else:
+            names, forward = ("W_gate", "W_in", "W_out"), _quantized_gated_mlp_forward
+
+        for name in names:
+            # Removing the fp32 parameter frees its memory
+            mlp.add_module(f"{name}_int8", _quantize_linear(mlp._parameters.pop(name)))
+        mlp.forward = types.MethodType(forward, mlp)
@@ -0,0 +1,100 @@
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Callable, TypeVar
+import torch as t
+from pydantic import BaseModel
+from torch.profiler import ProfilerActivity, profile
+import src.config as config
+from src.schemas import ProfileInfo
+
+logger = logging.getLogger(__name__)
+
+ServiceT = TypeVar("ServiceT", bound=Callable)
+
+# Only one profiler can run per process, and captures are rate-limited
+_capture_lock = threading.Lock()
+_last_capture = -float("inf")
+
+
+def _start_capture() -> bool:
+    """Reserves the profiler if no capture is running and the last one started at least
+    config.PROFILE_MIN_INTERVAL_SECONDS ago."""
+
+    global _last_capture
+
+    if not _capture_lock.acquire(blocking=False):
+        return False
+    if time.monotonic() - _last_capture < config.PROFILE_MIN_INTERVAL_SECONDS:
+        _capture_lock.release()
+        return False
+
+    _last_capture = time.monotonic()
+    return True
+
+
+def write_profile(prof: profile, name: str, use_cuda: bool) -> ProfileInfo:
+    """Writes the Chrome trace and the top ops table of a finished capture to
+    config.PROFILE_DIR."""
+
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+    stem = os.path.join(
+        config.PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}"
+    )
+
+    trace_path = f"{stem}.trace.json"
+    prof.export_chrome_trace(trace_path)
+
+    top_ops_path = f"{stem}.top_ops.txt"
+    sort_by = "cuda_time_total" if use_cuda else "cpu_time_total"
+    with open(top_ops_path, "w") as f:
+        f.write(prof.key_averages().table(sort_by=sort_by, row_limit=config.PROFILE_TOP_OPS))
+
+    return ProfileInfo(trace_path=trace_path, top_ops_path=top_ops_path)
+
+
+def profiled(service: ServiceT) -> ServiceT:
+    """Wraps a service function taking (request, model) so that requests with profile set run
+    under torch.profiler, on the CPU and on CUDA when available. The trace and top ops table are
+    written to config.PROFILE_DIR and referenced in the response's profile field, which stays None
+    if they cannot be written.
+
+    Profiling is skipped (the request runs normally) when config.PROFILE_DIR is empty, while
+    another capture is running in the process, or within config.PROFILE_MIN_INTERVAL_SECONDS of
+    the previous capture.
+    """
+
+    @functools.wraps(service)
+    def wrapper(request: BaseModel, model=None):
+        if not getattr(request, "profile", False) or not config.PROFILE_DIR:
+            return service(request, model)
+
+        if not _start_capture():
+            logger.warning(f"Not profiling {service.__name__}, profiling is rate limited")
+            return service(request, model)
+
+        try:
+            use_cuda = t.cuda.is_available()
+            activities = [ProfilerActivity.CPU]
+            if use_cuda:
+                activities.append(ProfilerActivity.CUDA)
+
+            with profile(activities=activities, record_shapes=True) as prof:
+                response = service(request, model)
+
+            # The service already succeeded, so a failed write only loses the profile
+            try:
+                info = write_profile(prof, service.__name__, use_cuda)
+                logger.info(f"Wrote the profile of {service.__name__} to {info.trace_path}")
+            except Exception as e:
+                logger.warning(f"Could not write the profile of {service.__name__}: {e}")
+                return response
+        finally:
+            _capture_lock.release()
+
+        return response.model_copy(update={"profile": info})
+
+    return wrapper
@@ -0,0 +1,228 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, TypeVar
+from pydantic import BaseModel
+import src.config as config
+from src.metrics import metrics
+from src.precision import configured_precision
+
+logger = logging.getLogger(__name__)
+
+ResponseT = TypeVar("ResponseT", bound=BaseModel)
+
+
+class ResultCache:
+    """
+    Content-addressed cache of service responses.
+
+    Responses are stored as their serialized JSON under a hash of the normalized request. The
+    in-memory tier is an LRU bounded by a byte budget, and an optional on-disk tier (one file per
+    key) survives restarts. Concurrent requests for the same key share a single computation.
+
+    The disk tier is best-effort: its I/O runs in worker threads, off the event loop, and a failing
+    read or write is logged and treated as a miss.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str | None = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+        self._disk_lock = threading.Lock()
+        self._disk_size = 0
+        if disk_dir:
+            try:
+                os.makedirs(disk_dir, exist_ok=True)
+                self._disk_size = sum(entry.stat().st_size for entry in self._disk_entries())
+            except OSError as e:
+                logger.warning(f"Disabling the result cache disk tier at {disk_dir}: {e}")
+                self.disk_dir = None
+
+    def key(self, kind: str, request: BaseModel) -> str:
+        """Returns the cache key of a request: a hash of the service kind, the request with all
+        defaults filled in, the precision its model is configured to run in, and
+        config.RESULT_CACHE_VERSION (bump it when model weights or service outputs change).
+        """
+
+        normalized = json.dumps(
+            {
+                "kind": kind,
+                "version": config.RESULT_CACHE_VERSION,
+                "precision": configured_precision(request.model_name),
+                "request": request.model_dump(mode="json"),
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    async def get(self, key: str) -> bytes | None:
+        """Returns the serialized response stored under key, checking memory and then disk."""
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        if not self.disk_dir:
+            return None
+
+        data = await asyncio.to_thread(self._get_disk, key)
+        if data is not None:
+            self._put_memory(key, data)
+        return data
+
+    async def put(self, key: str, data: bytes):
+        """Stores a serialized response in memory and, if enabled, on disk."""
+
+        self._put_memory(key, data)
+        if self.disk_dir:
+            await asyncio.to_thread(self._put_disk, key, data)
+
+    async def get_or_compute(
+        self,
+        key: str,
+        response_type: type[ResponseT],
+        compute: Callable[[], Awaitable[ResponseT]],
+    ) -> ResponseT:
+        """Returns the cached response for key, or computes and caches it.
+
+        If the same key is already being computed, this waits for that computation instead of
+        starting another one. The computation is shielded, so a cancelled caller does not cancel it
+        for the others.
+
+        Args:
+            key: The cache key, see key()
+            response_type: The pydantic model the response is deserialized into
+            compute: Async function computing the response on a cache miss
+
+        Returns:
+            The response
+        """
+
+        data = await self.get(key)
+        if data is not None:
+            logger.info(f"Result cache hit for {key[:12]}")
+            return response_type.model_validate_json(data)
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._compute_and_store(key, compute))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            logger.info(f"Waiting for in-flight computation of {key[:12]}")
+
+        data = await asyncio.shield(task)
+        return response_type.model_validate_json(data)
+
+    async def _compute_and_store(
+        self, key: str, compute: Callable[[], Awaitable[BaseModel]]
+    ) -> bytes:
+        response = await compute()
+        with metrics.stage("cache_serialize"):
+            data = response.model_dump_json().encode()
+        await self.put(key, data)
+        return data
+
+    def _put_memory(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key))
+
+        self._entries[key] = data
+        self._size += len(data)
+
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_entries(self) -> list[os.DirEntry]:
+        return [entry for entry in os.scandir(self.disk_dir) if entry.name.endswith(".json")]
+
+    def _get_disk(self, key: str) -> bytes | None:
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # Keeps the disk tier's eviction order least recently used
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Could not read result cache entry {key[:12]}: {e}")
+            return None
+        return data
+
+    def _put_disk(self, key: str, data: bytes):
+        if len(data) > self.disk_max_bytes:
+            return
+
+        path = self._disk_path(key)
+        # Write then rename so a crash never leaves a partial entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self._disk_lock:
+            if os.path.exists(path):
+                return
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Could not write result cache entry {key[:12]}: {e}")
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                return
+            self._disk_size += len(data)
+
+            if self._disk_size > self.disk_max_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        """Removes the least recently used disk entries until the disk tier fits its budget."""
+
+        entries = []
+        try:
+            for entry in self._disk_entries():
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Removed by another process since the listing
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError as e:
+            logger.warning(f"Could not list the result cache disk tier: {e}")
+            return
+
+        for _, size, path in sorted(entries):
+            if self._disk_size <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not evict result cache entry {path}: {e}")
+                continue
+            self._disk_size -= size
+
+
+result_cache = ResultCache(
+    max_bytes=config.RESULT_CACHE_MAX_MB * 2**20,
+    disk_dir=config.RESULT_CACHE_DIR or None,
+    disk_max_bytes=config.RESULT_CACHE_DISK_MAX_MB * 2**20,
+)
@@ -1,33 +1,83 @@
-from fastapi import APIRouter
-from src.modal_app import runners
-from src.schemas import LogitLensRequest
-import src.config as config
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from src.schemas import LogitLensBatchRequest, LogitLensRequest, LogitLensResponse
 import logging
-from src.helpers import update_model_expiration
-from src.services.logitlens import logitlens
-import modal
-from fastapi.concurrency import run_in_threadpool
+from src.backends import get_runner_backend
+from src.helpers import prefetch_first, profile_requested, update_model_expiration
+from src.metrics import TimedRoute
+from src.result_cache import result_cache
 
 router = APIRouter(
     prefix="/logitlens",
     tags=["logitlens"],
+    route_class=TimedRoute,
 )
 
 logger = logging.getLogger(__name__)
 
 
 @router.post("")
-async def logitlens_endpoint(request: LogitLensRequest):
+async def logitlens_endpoint(
+    request: LogitLensRequest, profile: bool = Depends(profile_requested)
+):
     model_name = request.model_name
+    if profile:
+        request = request.model_copy(update={"profile": True})
 
-    if config.USE_MODAL:
-        ModelRunner = modal.Cls.from_name(config.MODAL_APP_NAME, runners[model_name])
-        model_runner = ModelRunner()
-        ts = update_model_expiration(request.model_name)
-        logger.info(f"Loaded model {request.model_name} at {ts}")
-        return await run_in_threadpool(model_runner.logitlens.remote, request)
-    else:
-        response = logitlens(request)
+    async def compute():
+        response = await get_runner_backend().run(model_name, "logitlens", request)
         ts = update_model_expiration(request.model_name)
         logger.info(f"Loaded model {request.model_name} at {ts}")
         return response
+
+    if request.profile:
+        # A profile needs a fresh run, so the result cache is bypassed
+        return await compute()
+
+    key = result_cache.key("logitlens", request)
+    return await result_cache.get_or_compute(key, LogitLensResponse, compute)
+
+
+@router.post("/batch")
+async def logitlens_batch_endpoint(request: LogitLensBatchRequest):
+    """Runs the logit lens over several inputs with batched forward passes.
+
+    Returns:
+        A list of logit lens responses in the order of request.inputs
+    """
+    model_name = request.model_name
+
+    response = await get_runner_backend().run(model_name, "logitlens_batch", request)
+    ts = update_model_expiration(request.model_name)
+    logger.info(f"Loaded model {request.model_name} at {ts}")
+    return response
+
+
+@router.post("/stream")
+async def logitlens_stream_endpoint(request: LogitLensRequest):
+    """Streams the logit lens as newline delimited JSON: the input tokens first, then each layer as
+    soon as it has been computed, then the most likely token.
+    """
+    model_name = request.model_name
+
+    if request.include_final_token_rank:
+        raise HTTPException(
+            status_code=422,
+            detail="include_final_token_rank is not supported when streaming",
+        )
+
+    ts = update_model_expiration(request.model_name)
+    logger.info(f"Loaded model {request.model_name} at {ts}")
+
+    stream = await prefetch_first(
+        await get_runner_backend().stream(model_name, "logitlens_stream", request)
+    )
+
+    async def events():
+        try:
+            async for event in stream:
+                yield event.model_dump_json(exclude_none=True) + "\n"
+        finally:
+            await stream.aclose()
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
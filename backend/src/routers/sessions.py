@@ -0,0 +1,73 @@
+from fastapi import APIRouter, Response
+from src.schemas import (
+    SessionAttentionRequest,
+    SessionCreateRequest,
+    SessionLensRequest,
+    SessionRequest,
+)
+import logging
+from src.backends import get_runner_backend
+from src.helpers import update_model_expiration
+from src.metrics import TimedRoute
+
+router = APIRouter(
+    prefix="/sessions",
+    tags=["sessions"],
+    route_class=TimedRoute,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@router.post("")
+async def create_session_endpoint(request: SessionCreateRequest):
+    """Runs one forward pass and keeps its activations, so that the lens, norms and attention
+    patterns can be queried repeatedly without running the model again.
+
+    Sessions expire after SESSION_TTL_SECONDS without use and may be evicted earlier under memory
+    pressure; requests for a missing session return 404 and the session should be recreated.
+    """
+    model_name = request.model_name
+
+    response = await get_runner_backend().run(model_name, "create_session", request)
+    update_model_expiration(model_name)
+    return response
+
+
+@router.post("/lens")
+async def session_lens_endpoint(request: SessionLensRequest):
+    """Applies the logit lens to a session's stored residuals."""
+    model_name = request.model_name
+
+    response = await get_runner_backend().run(model_name, "session_lens", request)
+    update_model_expiration(model_name)
+    return response
+
+
+@router.post("/norms")
+async def session_norms_endpoint(request: SessionRequest):
+    """Returns the residual norm of every stored layer and position of a session."""
+    model_name = request.model_name
+
+    response = await get_runner_backend().run(model_name, "session_norms", request)
+    update_model_expiration(model_name)
+    return response
+
+
+@router.post("/attention")
+async def session_attention_endpoint(request: SessionAttentionRequest):
+    """Returns the attention patterns of one layer of a session."""
+    model_name = request.model_name
+
+    response = await get_runner_backend().run(model_name, "session_attention", request)
+    update_model_expiration(model_name)
+    return response
+
+
+@router.delete("/{session_id}", status_code=204)
+async def delete_session_endpoint(session_id: str, model_name: str):
+    """Frees a session's memory before it expires."""
+    request = SessionRequest(model_name=model_name, session_id=session_id)
+
+    await get_runner_backend().run(model_name, "delete_session", request)
+    return Response(status_code=204)
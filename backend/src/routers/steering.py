@@ -1,17 +1,21 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
 from src.schemas import (
     RunWithSteeringRequest,
+    RunWithSteeringResponse,
+    SteeringSweepRequest,
     SteeringVectorRequest,
 )
-import src.config as config
-from src.services.steering import calculate_steering_vectors, run_with_steering
-from src.helpers import update_model_expiration
-import modal
-from src.modal_app import runners
-from fastapi.concurrency import run_in_threadpool
+from src.backends import get_runner_backend
+from src.helpers import prefetch_first, profile_requested, update_model_expiration
+from src.metrics import TimedRoute
+from src.result_cache import result_cache
+import logging
 
 
-router = APIRouter(prefix="/steering", tags=["steering"])
+router = APIRouter(prefix="/steering", tags=["steering"], route_class=TimedRoute)
+
+logger = logging.getLogger(__name__)
 
 
 @router.get("/available_models")
@@ -21,42 +25,103 @@ async def available_models_endpoint():
 
 @router.post("/calculate")
 async def calculate_steering_vectors_endpoint(
-    request: SteeringVectorRequest,
+    request: SteeringVectorRequest, profile: bool = Depends(profile_requested)
 ):
     model_name = request.model_name
-    response = None
+    if profile:
+        request = request.model_copy(update={"profile": True})
 
-    if config.USE_MODAL:
-        ModelRunner = modal.Cls.from_name(config.MODAL_APP_NAME, runners[model_name])
-        model_runner = ModelRunner()
-        response = await run_in_threadpool(
-            model_runner.calculate_steering_vectors.remote, request
-        )
-    else:
-        response = calculate_steering_vectors(request)
+    response = await get_runner_backend().run(
+        model_name, "calculate_steering_vectors", request
+    )
 
     update_model_expiration(request.model_name)
     return response
 
 
 @router.post("/run_with_steering")
-async def run_with_steering_endpoint(request: RunWithSteeringRequest):
+async def run_with_steering_endpoint(
+    request: RunWithSteeringRequest, profile: bool = Depends(profile_requested)
+):
     """Runs the model with and without the steering vectors.
 
     Args:
       request: The run with steering request containing model name and prompts
+      profile: Whether to capture a profile of the run, see src/profiling.py
     """
     model_name = request.model_name
-    response = None
+    if profile:
+        request = request.model_copy(update={"profile": True})
+
+    async def compute():
+        response = await get_runner_backend().run(model_name, "run_with_steering", request)
+        update_model_expiration(request.model_name)
+        return response
+
+    if request.profile:
+        # A profile needs a fresh run, so the result cache is bypassed
+        return await compute()
+
+    key = result_cache.key("run_with_steering", request)
+    return await result_cache.get_or_compute(key, RunWithSteeringResponse, compute)
+
+
+@router.post("/run_with_steering/stream")
+async def stream_with_steering_endpoint(
+    request: RunWithSteeringRequest, http_request: Request
+):
+    """Streams the steered and unsteered responses as newline delimited JSON events while they are
+    generated. Generation stops early when the client disconnects.
 
-    if config.USE_MODAL:
-        ModelRunner = modal.Cls.from_name(config.MODAL_APP_NAME, runners[model_name])
-        model_runner = ModelRunner()
-        response = await run_in_threadpool(
-            model_runner.run_with_steering.remote, request
-        )
-    else:
-        response = run_with_steering(request)
+    Args:
+      request: The run with steering request containing model name and prompts
+      http_request: The underlying HTTP request, polled for client disconnects
+    """
+    model_name = request.model_name
 
     update_model_expiration(request.model_name)
-    return response
+
+    stream = await prefetch_first(
+        await get_runner_backend().stream(model_name, "stream_with_steering", request)
+    )
+
+    async def events():
+        try:
+            async for event in stream:
+                if await http_request.is_disconnected():
+                    logger.info("Client disconnected, cancelling generation")
+                    break
+                yield event.model_dump_json() + "\n"
+        finally:
+            # Stops the decode loop
+            await stream.aclose()
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@router.post("/sweep")
+async def sweep_steering_endpoint(request: SteeringSweepRequest):
+    """Generates a response for every combination of request.layers and request.scaling_factors
+    with batched generation. Results are streamed as newline delimited JSON as soon as each
+    configuration is done, so they arrive out of order.
+
+    Args:
+      request: The sweep request containing model name, prompt and the layer/scale grid
+    """
+    model_name = request.model_name
+
+    update_model_expiration(request.model_name)
+
+    # The requested layers are checked against the steering vectors before the first result
+    stream = await prefetch_first(
+        await get_runner_backend().stream(model_name, "sweep_steering", request)
+    )
+
+    async def results():
+        try:
+            async for result in stream:
+                yield result.model_dump_json() + "\n"
+        finally:
+            await stream.aclose()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
@@ -1,21 +1,116 @@
-from pydantic import BaseModel
+from typing import Annotated
+from pydantic import BaseModel, Field, model_validator
 
 
 class LogitLensLayer(BaseModel):
     hook_name: str
     max_probs: list[float]
     max_prob_tokens: list[str]
+    # Only populated when requested, see LogitLensRequest
+    top_k_probs: list[list[float]] | None = None
+    top_k_tokens: list[list[str]] | None = None
+    entropy: list[float] | None = None
+    final_token_rank: list[int] | None = None
 
 
-class LogitLensRequest(BaseModel):
+class LogitLensOptions(BaseModel):
+    # Subsets of layers / token positions to lens. None means all of them.
+    layers: list[int] | None = Field(default=None, min_length=1)
+    positions: list[int] | None = Field(default=None, min_length=1)
+    # Number of most probable tokens to return per position (top_k_probs/top_k_tokens when > 1)
+    top_k: int = Field(default=1, ge=1)
+    include_entropy: bool = False
+    # Rank of the model's final predicted token in each layer's distribution (0 = most probable)
+    include_final_token_rank: bool = False
+
+
+class LogitLensRequest(LogitLensOptions):
     model_name: str
-    input: str
+    input: str = Field(min_length=1)
+    # Capture a torch profiler trace of the request (see src/profiling.py). Also set by the
+    # X-Profile header or ?profile=true. Ignored by the streaming endpoints.
+    profile: bool = False
+
+
+class LogitLensBatchRequest(LogitLensOptions):
+    model_name: str
+    inputs: list[Annotated[str, Field(min_length=1)]] = Field(min_length=1)
+
+
+class ProfileInfo(BaseModel):
+    # Chrome trace (open in chrome://tracing or https://ui.perfetto.dev)
+    trace_path: str
+    # Table of the ops with the most total time
+    top_ops_path: str
 
 
 class LogitLensResponse(BaseModel):
     input_tokens: list[str]
     most_likely_token: str
     logit_lens: list[LogitLensLayer]
+    # The token positions each layer's lists refer to
+    positions: list[int] | None = None
+    # The precision the model ran in (fp32, bf16 or int8)
+    precision: str | None = None
+    # Where the profiler output of a profiled request was written
+    profile: ProfileInfo | None = None
+
+
+class SessionCreateRequest(BaseModel):
+    model_name: str
+    input: str = Field(min_length=1)
+    # Layers whose residuals are stored. None stores all of them.
+    layers: list[int] | None = Field(default=None, min_length=1)
+    # Also store the attention patterns of the stored layers
+    include_attention: bool = False
+
+
+class SessionInfo(BaseModel):
+    session_id: str
+    input_tokens: list[str]
+    layers: list[int]
+    include_attention: bool
+    size_mb: float
+    # The session is dropped after this many seconds without a request
+    ttl_seconds: float
+
+
+class SessionRequest(BaseModel):
+    model_name: str
+    session_id: str
+
+
+# Logit lens of a session. layers must be a subset of the session's layers (None means all of them)
+class SessionLensRequest(SessionRequest, LogitLensOptions):
+    pass
+
+
+class SessionNormsResponse(BaseModel):
+    layers: list[int]
+    # L2 norm of the residual stream at each [layer][position]
+    norms: list[list[float]]
+
+
+class SessionAttentionRequest(SessionRequest):
+    layer: int
+    # None means all heads
+    heads: list[int] | None = Field(default=None, min_length=1)
+
+
+class SessionAttentionResponse(BaseModel):
+    layer: int
+    heads: list[int]
+    # Attention probabilities at each [head][query position][key position]
+    patterns: list[list[list[float]]]
+
+
+# One line of a streamed logit lens response. Exactly one group of fields is set: the input tokens
+# (first event), a layer, or the most likely token (last event).
+class LogitLensStreamEvent(BaseModel):
+    input_tokens: list[str] | None = None
+    positions: list[int] | None = None
+    layer: LogitLensLayer | None = None
+    most_likely_token: str | None = None
 
 
 class SteeringVectorRequest(BaseModel):
@@ -23,21 +118,133 @@ class SteeringVectorRequest(BaseModel):
     user_prompts: list[str]
     assistant_positive_responses: list[str]
     assistant_negative_responses: list[str]
+    # Set to False to only get the registry ID back instead of every layer's vector
+    return_vectors: bool = True
+    # Capture a torch profiler trace of the request (see src/profiling.py). Also set by the
+    # X-Profile header or ?profile=true. Ignored by the streaming endpoints.
+    profile: bool = False
 
 
 class SteeringVectorResponse(BaseModel):
-    steering_vectors: dict[int, list[float]]
+    steering_vectors: dict[int, list[float]] | None = None
+    # ID of the vectors in the server-side registry, usable instead of steering_vectors in requests
+    steering_vector_id: str | None = None
+    # The precision the model ran in (fp32, bf16 or int8)
+    precision: str | None = None
+    # Where the profiler output of a profiled request was written
+    profile: ProfileInfo | None = None
+
+
+class SteeringVectorSource(BaseModel):
+    # Exactly one of the vectors themselves or the registry ID returned by /steering/calculate
+    steering_vectors: dict[int, list[float]] | None = None
+    steering_vector_id: str | None = None
+
+    @model_validator(mode="after")
+    def check_one_source(self):
+        if (self.steering_vectors is None) == (self.steering_vector_id is None):
+            raise ValueError("Exactly one of steering_vectors or steering_vector_id must be set")
+        # The length is checked against the model's d_model by the services
+        lengths = {len(vector) for vector in (self.steering_vectors or {}).values()}
+        if 0 in lengths or len(lengths) > 1:
+            raise ValueError("The steering vectors must be non-empty and of the same length")
+        return self
+
+
+# One layer of a multi-layer steering run. Vectors of repeated layers are added together.
+class SteeringLayer(BaseModel):
+    layer: int
+    scaling_factor: float = 1.0
+    # Prompt positions to steer (negative indices count from the end of the prompt, including
+    # its special tokens). None steers every prompt position.
+    positions: list[int] | None = None
+    # Also steer the generated tokens
+    steer_generated: bool = True
 
 
-class RunWithSteeringRequest(BaseModel):
+class RunWithSteeringRequest(SteeringVectorSource):
     model_name: str
     prompt: str
-    steering_vectors: dict[int, list[float]]
-    layer: int
+    # Either a single layer steered at every position with scaling_factor, or several layers
+    layer: int | None = None
     scaling_factor: float = 1.0
+    steering: list[SteeringLayer] | None = Field(default=None, min_length=1)
     max_tokens: int
+    # Capture a torch profiler trace of the request (see src/profiling.py). Also set by the
+    # X-Profile header or ?profile=true. Ignored by the streaming endpoints.
+    profile: bool = False
+
+    @model_validator(mode="after")
+    def check_one_steering(self):
+        if (self.layer is None) == (self.steering is None):
+            raise ValueError("Exactly one of layer or steering must be set")
+        return self
+
+    def steering_layers(self) -> list[SteeringLayer]:
+        """Returns the steered layers, converting a single layer request."""
+
+        if self.steering is not None:
+            return self.steering
+        return [SteeringLayer(layer=self.layer, scaling_factor=self.scaling_factor)]
 
 
 class RunWithSteeringResponse(BaseModel):
     steered_response: str
     unsteered_response: str
+    # The precision the model ran in (fp32, bf16 or int8)
+    precision: str | None = None
+    # Where the profiler output of a profiled request was written
+    profile: ProfileInfo | None = None
+
+
+class RunWithSteeringStreamEvent(BaseModel):
+    # Either "steered" or "unsteered"
+    branch: str
+    # The text generated since the previous event of the same branch
+    text: str
+    done: bool = False
+
+
+class SteeringSweepRequest(SteeringVectorSource):
+    model_name: str
+    prompt: str
+    # Every combination of layer and scaling factor is generated
+    layers: list[int] = Field(min_length=1)
+    scaling_factors: list[float] = Field(min_length=1)
+    max_tokens: int
+    include_unsteered: bool = True
+
+
+class SteeringSweepResult(BaseModel):
+    # None for the unsteered response
+    layer: int | None
+    scaling_factor: float | None
+    response: str
+    # The precision the model ran in (fp32, bf16 or int8)
+    precision: str | None = None
+
+
+class LoadedModelInfo(BaseModel):
+    # RFC 3339 UTC timestamp of the last request that used the model
+    last_used: str
+    size_mb: float
+    precision: str
+
+
+class ModelManagerState(BaseModel):
+    # 0 when there is no budget / idle TTL
+    memory_budget_mb: float
+    used_mb: float
+    idle_ttl_seconds: int
+    models: dict[str, LoadedModelInfo]
+    # Models currently being loaded
+    loading: list[str]
+
+
+class WorkerState(BaseModel):
+    # Requests waiting for the model, including streams between their steps
+    queue_depth: int
+    # Requests beyond this depth are rejected with a 503
+    max_queue_depth: int
+    # Whether the worker is running a request
+    running: bool
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import logging
+import os
+import uuid
+import numpy as np
+import torch as t
+import src.config as config
+from src.precision import configured_precision
+
+logger = logging.getLogger(__name__)
+
+
+class ActivationSums:
+    """Running per-layer sums of activation vectors and the number of vectors summed, so that means
+    over any number of prompts take O(layers * d_model) memory."""
+
+    def __init__(self):
+        self.sums: dict[int, t.Tensor] = {}
+        self.count = 0
+
+    def add(self, activations: dict[int, t.Tensor]):
+        """Adds a batch of { layer_idx: tensor [batch, d_model] } activations."""
+
+        for layer_idx, acts in activations.items():
+            batch_sum = acts.sum(dim=0, dtype=t.float32)
+            if layer_idx in self.sums:
+                self.sums[layer_idx] += batch_sum.to(self.sums[layer_idx].device)
+            else:
+                self.sums[layer_idx] = batch_sum
+
+        self.count += next(iter(activations.values())).shape[0]
+
+    def mean(self, layer_idx: int) -> t.Tensor:
+        return self.sums[layer_idx] / self.count
+
+
+def prompt_key(prompt: str) -> str:
+    """Returns the key of a formatted prompt in the activation store."""
+
+    return hashlib.sha256(prompt.encode()).hexdigest()
+
+
+class ActivationStore:
+    """
+    Persistent store of the last-token resid_post vectors of every layer for the prompts a model
+    has seen in one precision, keyed by a hash of the formatted prompt.
+
+    The store is append-only: each add() writes a chunk, a [prompts, layers, d_model] float32 .npy
+    array plus a JSON list of its prompt keys. Chunks are memory-mapped when read, so summing
+    stored activations never loads a whole chunk. Chunks written by other processes sharing the
+    directory (e.g. other Modal containers, after a volume reload) are indexed by missing().
+    """
+
+    def __init__(self, model_name: str, precision: str):
+        self.dir = os.path.join(config.ACTIVATION_STORE_DIR, model_name, precision)
+        os.makedirs(self.dir, exist_ok=True)
+
+        # prompt key -> (chunk name, row)
+        self.index: dict[str, tuple[str, int]] = {}
+        self._chunks: set[str] = set()
+        self.refresh()
+
+    def refresh(self):
+        """Indexes the chunks in the directory that are not indexed yet."""
+
+        for name in os.listdir(self.dir):
+            if name.endswith(".keys.json"):
+                chunk = name.removesuffix(".keys.json")
+                if chunk not in self._chunks:
+                    self._index_chunk(chunk)
+
+    def _index_chunk(self, chunk: str):
+        with open(os.path.join(self.dir, f"{chunk}.keys.json")) as f:
+            for row, key in enumerate(json.load(f)):
+                self.index[key] = (chunk, row)
+        self._chunks.add(chunk)
+
+    def missing(self, prompts: list[str]) -> list[int]:
+        """Returns the indices of the prompts without stored activations (each prompt once),
+        after indexing the chunks added to the directory since the last call."""
+
+        self.refresh()
+
+        seen = set()
+        missing = []
+        for idx, prompt in enumerate(prompts):
+            key = prompt_key(prompt)
+            if key not in self.index and key not in seen:
+                seen.add(key)
+                missing.append(idx)
+
+        return missing
+
+    def add(self, prompts: list[str], activations: dict[int, t.Tensor]):
+        """Stores the activations of the prompts as a new chunk.
+
+        Args:
+            prompts: The formatted prompts
+            activations: A dict of { layer_idx: tensor [prompts, d_model] } covering every layer
+        """
+
+        layers = sorted(activations.keys())
+        stacked = t.stack([activations[layer] for layer in layers], dim=1)
+        chunk = uuid.uuid4().hex
+
+        # The keys are written last, so a chunk only becomes visible once its array is complete
+        np.save(
+            os.path.join(self.dir, f"{chunk}.npy"),
+            stacked.to("cpu", t.float32).numpy(),
+        )
+        keys_path = os.path.join(self.dir, f"{chunk}.keys.json")
+        with open(f"{keys_path}.tmp", "w") as f:
+            json.dump([prompt_key(prompt) for prompt in prompts], f)
+        os.replace(f"{keys_path}.tmp", keys_path)
+
+        self._index_chunk(chunk)
+
+    def sum(self, prompts: list[str]) -> ActivationSums:
+        """Sums the stored activations of the prompts (counting repeated prompts repeatedly). Every
+        prompt must have stored activations, see missing().
+        """
+
+        rows_by_chunk: dict[str, list[int]] = {}
+        for prompt in prompts:
+            chunk, row = self.index[prompt_key(prompt)]
+            rows_by_chunk.setdefault(chunk, []).append(row)
+
+        sums = ActivationSums()
+        for chunk, rows in rows_by_chunk.items():
+            array = np.load(os.path.join(self.dir, f"{chunk}.npy"), mmap_mode="r")
+            acts = t.from_numpy(np.ascontiguousarray(array[rows]))  # [rows, layers, d_model]
+            sums.add({layer: acts[:, layer] for layer in range(acts.shape[1])})
+
+        return sums
+
+
+_stores: dict[tuple[str, str], ActivationStore] = {}
+
+
+def get_activation_store(model_name: str) -> ActivationStore:
+    """Returns the activation store of a model in its configured precision, so that activations
+    computed in different precisions are never summed together. Its index is read on first use."""
+
+    key = (model_name, configured_precision(model_name))
+    if key not in _stores:
+        _stores[key] = ActivationStore(*key)
+
+    return _stores[key]
@@ -1,74 +1,433 @@
 from typing import NamedTuple
 from torch import Tensor
-from src.schemas import LogitLensRequest, LogitLensLayer, LogitLensResponse
+from src.schemas import (
+    LogitLensBatchRequest,
+    LogitLensLayer,
+    LogitLensOptions,
+    LogitLensRequest,
+    LogitLensResponse,
+    LogitLensStreamEvent,
+)
 import logging
 from transformer_lens.hook_points import HookPoint
 import torch as t
 from transformer_lens import HookedTransformer
-from src.helpers import load_model
+from src.helpers import InvalidRequest, bucket_by_length
+from src.model_manager import load_model
+from src.precision import model_precision
+import src.config as config
+from src.metrics import metrics
+from src.profiling import profiled
+from src.state import vocab_strings
 
 logger = logging.getLogger(__name__)
 
 
-class RawResid(NamedTuple):
-    hook_name: str
-    resid: Tensor
+def get_vocab_strings(model: HookedTransformer) -> list[str]:
+    """Returns the decoded string of every token id in the model's vocabulary. The table is built
+    once per model so that decoding the lens output is a list lookup instead of a tokenizer call per
+    position.
+    """
+
+    model_name = model.cfg.model_name
+    if model_name not in vocab_strings:
+        logger.info(f"Building vocab string table for {model_name}...")
+        vocab_strings[model_name] = model.tokenizer.batch_decode(
+            [[idx] for idx in range(model.cfg.d_vocab)],
+            clean_up_tokenization_spaces=False,
+        )
+
+    return vocab_strings[model_name]
+
+
+def resolve_indices(indices: list[int] | None, length: int, kind: str) -> list[int]:
+    """Converts a (possibly negative) list of indices into sorted, unique, non-negative indices.
+
+    Args:
+        indices: The requested indices. If None, all indices in range(length) are returned.
+        length: The size of the dimension being indexed.
+        kind: What is being indexed, used in the error message.
+
+    Returns:
+        The sorted list of unique indices.
+    """
+
+    if indices is None:
+        return list(range(length))
+
+    for idx in indices:
+        if not -length <= idx < length:
+            raise InvalidRequest(f"{kind} index {idx} is out of range for length {length}")
+
+    return sorted({idx % length for idx in indices})
+
+
+# Bytes held per logit while a vocab chunk is processed: the float32 logits, their exponentials and
+# the logit * exp product used for the entropy.
+BYTES_PER_LOGIT = 12
+
+
+class LensStats(NamedTuple):
+    top_probs: Tensor  # [layers, pos, k]
+    top_token_indices: Tensor  # [layers, pos, k]
+    entropy: Tensor | None  # [layers, pos]
+    target_ranks: Tensor | None  # [layers, pos]
+
+
+def vocab_chunk_size(n_rows: int, d_vocab: int, top_k: int = 1) -> int:
+    """Returns how many vocab columns can be unembedded at once for n_rows residuals while staying
+    within config.LOGITLENS_MEMORY_BUDGET_MB.
+    """
+
+    budget = config.LOGITLENS_MEMORY_BUDGET_MB * 2**20
+    chunk_size = budget // (n_rows * BYTES_PER_LOGIT)
+    return int(min(d_vocab, max(chunk_size, top_k, 1)))
+
+
+def lens_stats(
+    model: HookedTransformer,
+    resids: Tensor,
+    top_k: int = 1,
+    include_entropy: bool = False,
+    target_token_indices: Tensor | None = None,
+) -> LensStats:
+    """Applies the final layer norm and unembedding to a stack of residuals and returns statistics of
+    the resulting next token distributions.
+
+    The vocabulary is walked in chunks sized by vocab_chunk_size while keeping a running max,
+    sum of exponentials (logsumexp) and top-k, so the full [layers, pos, d_vocab] distribution is
+    never materialized when it does not fit in the memory budget.
+
+    Args:
+        model: The model whose ln_final and unembedding are used
+        resids: A [layers, pos, d_model] tensor of residual stream vectors
+        top_k: The number of most probable tokens to return
+        include_entropy: Whether to compute the entropy of each distribution
+        target_token_indices: Optional [pos] token ids whose rank is computed at every layer
+
+    Returns:
+        The LensStats of the residuals
+    """
+
+    normed = model.ln_final(resids)  # [layers, pos, d_model]
+    n_layers, n_pos, _ = normed.shape
+    d_vocab = model.cfg.d_vocab_out
+    top_k = min(top_k, d_vocab)
+    chunk_size = vocab_chunk_size(n_layers * n_pos, d_vocab, top_k)
+
+    running_max = t.full((n_layers, n_pos), -t.inf, device=normed.device)
+    sum_exp = t.zeros((n_layers, n_pos), device=normed.device)
+    sum_exp_logits = t.zeros((n_layers, n_pos), device=normed.device)
+    top_logits = t.empty((n_layers, n_pos, 0), device=normed.device)
+    top_indices = t.empty((n_layers, n_pos, 0), dtype=t.long, device=normed.device)
+
+    target_ranks = None
+    if target_token_indices is not None:
+        target_logits = (
+            t.einsum("lpd,dp->lp", normed, model.W_U[:, target_token_indices])
+            + model.b_U[target_token_indices]
+        ).float()
+        target_ranks = t.zeros((n_layers, n_pos), dtype=t.long, device=normed.device)
+
+    for start in range(0, d_vocab, chunk_size):
+        end = min(start + chunk_size, d_vocab)
+        logits = (normed @ model.W_U[:, start:end] + model.b_U[start:end]).float()
+
+        chunk_top_logits, chunk_top_indices = logits.topk(min(top_k, end - start), dim=-1)
+        top_logits, merged = t.cat([top_logits, chunk_top_logits], dim=-1).topk(
+            min(top_k, top_logits.shape[-1] + chunk_top_logits.shape[-1]), dim=-1
+        )
+        top_indices = t.cat([top_indices, chunk_top_indices + start], dim=-1).gather(
+            -1, merged
+        )
+
+        new_max = t.maximum(running_max, logits.amax(dim=-1))
+        rescale = t.exp(running_max - new_max)
+        exp_logits = t.exp(logits - new_max[..., None])
+        sum_exp = sum_exp * rescale + exp_logits.sum(dim=-1)
+        if include_entropy:
+            sum_exp_logits = sum_exp_logits * rescale + (exp_logits * logits).sum(dim=-1)
+        running_max = new_max
+
+        if target_ranks is not None:
+            greater = logits > target_logits[..., None]
+            # Never count the target against itself, whatever the rounding of target_logits
+            in_chunk = (target_token_indices >= start) & (target_token_indices < end)
+            local_indices = (target_token_indices - start).clamp(0, end - start - 1)
+            local_indices = local_indices.expand(n_layers, n_pos)[..., None]
+            greater.scatter_(
+                -1, local_indices, greater.gather(-1, local_indices) & ~in_chunk[..., None]
+            )
+            target_ranks += greater.sum(dim=-1)
+
+    logsumexp = running_max + t.log(sum_exp)
+    entropy = logsumexp - sum_exp_logits / sum_exp if include_entropy else None
+
+    return LensStats(
+        top_probs=t.exp(top_logits - logsumexp[..., None]),
+        top_token_indices=top_indices,
+        entropy=entropy,
+        target_ranks=target_ranks,
+    )
+
+
+def to_lens_layer(
+    hook_name: str,
+    top_probs: list[list[float]],
+    top_token_indices: list[list[int]],
+    entropy: list[float] | None,
+    ranks: list[int] | None,
+    vocab: list[str],
+    top_k: int,
+) -> LogitLensLayer:
+    """Builds the LogitLensLayer of one layer of one sequence from the (per position) lens stats."""
+
+    top_tokens = [[vocab[idx] for idx in pos_indices] for pos_indices in top_token_indices]
+
+    return LogitLensLayer(
+        hook_name=hook_name,
+        max_probs=[pos_probs[0] for pos_probs in top_probs],
+        max_prob_tokens=[pos_tokens[0] for pos_tokens in top_tokens],
+        top_k_probs=top_probs if top_k > 1 else None,
+        top_k_tokens=top_tokens if top_k > 1 else None,
+        entropy=entropy,
+        final_token_rank=ranks,
+    )
+
+
+def lens_tokens(
+    model: HookedTransformer,
+    tokens: Tensor,
+    lengths: list[int],
+    options: LogitLensOptions,
+) -> list[LogitLensResponse]:
+    """Runs a right-padded batch of token sequences through the model and applies the logit lens to
+    the requested layers and positions of every sequence.
+
+    All captured residuals of the batch are gathered into one [layers, positions, d_model] tensor and
+    unembedded together (in vocab chunks bounded by config.LOGITLENS_MEMORY_BUDGET_MB). The forward
+    pass stops after the last requested layer unless the final token ranks are needed.
+    most_likely_token is the top token of the deepest computed layer at a sequence's last real
+    position, which is the model's prediction when the last layer is included (the default).
+
+    Args:
+        model: The model to run
+        tokens: A [batch, pos] tensor of right-padded token ids
+        lengths: The number of real (non-padding) tokens in each sequence
+        options: The layers, positions and statistics to compute
+
+    Returns:
+        A LogitLensResponse for each sequence
+    """
 
+    if min(lengths) == 0:
+        raise InvalidRequest("Every input must contain at least one token")
 
+    n_layers = model.cfg.n_layers
+    layers = resolve_indices(options.layers, n_layers, "Layer")
+    hook_names = [f"blocks.{layer}.hook_resid_post" for layer in layers]
+    # The final token ranks are relative to the prediction of the last layer
+    stop_at_layer = n_layers if options.include_final_token_rank else layers[-1] + 1
+    deepest_hook_name = f"blocks.{stop_at_layer - 1}.hook_resid_post"
+
+    # Positions are resolved per sequence so that padding is never lensed
+    positions = [resolve_indices(options.positions, length, "Position") for length in lengths]
+    rows = t.tensor([row for row, pos in enumerate(positions) for _ in pos])
+    cols = t.tensor([col for pos in positions for col in pos])
+    last_cols = t.tensor(lengths) - 1
+
+    attention_mask = None
+    if min(lengths) < tokens.shape[1]:
+        attention_mask = (t.arange(tokens.shape[1]) < last_cols[:, None] + 1).long()
+
+    raw_resids: dict[str, Tensor] = {}
+
+    def post_resid_filter(name: str):
+        return name in hook_names or name == deepest_hook_name
+
+    def post_resid_hook(resid, hook: HookPoint):
+        raw_resids[hook.name] = resid[rows, cols]  # [positions, d_model]
+        if hook.name == deepest_hook_name:
+            raw_resids["last"] = resid[t.arange(len(lengths)), last_cols]
+
+    logger.info("Sending input to model...")
+
+    with t.inference_mode():
+        with metrics.stage("forward", device=tokens.device):
+            model.run_with_hooks(
+                tokens,
+                fwd_hooks=[(post_resid_filter, post_resid_hook)],
+                attention_mask=attention_mask,
+                stop_at_layer=stop_at_layer,
+            )
+
+    with t.inference_mode(), metrics.stage("unembed", device=tokens.device):
+        final_token_indices = None
+        if options.include_final_token_rank:
+            final_stats = lens_stats(model, raw_resids[deepest_hook_name][None])
+            final_token_indices = final_stats.top_token_indices[0, :, 0]
+
+        stats = lens_stats(
+            model,
+            t.stack([raw_resids[name] for name in hook_names]),
+            top_k=options.top_k,
+            include_entropy=options.include_entropy,
+            target_token_indices=final_token_indices,
+        )
+        most_likely_token_indices = lens_stats(model, raw_resids["last"][None]).top_token_indices
+
+    with metrics.stage("tokenize"):
+        input_tokens = [
+            model.to_str_tokens(tokens[row, :length]) for row, length in enumerate(lengths)
+        ]
+
+    with metrics.stage("decode"):
+        vocab = get_vocab_strings(model)
+        precision = model_precision(model)
+
+        top_probs = stats.top_probs.tolist()
+        top_token_indices = stats.top_token_indices.tolist()
+        entropy = stats.entropy.tolist() if stats.entropy is not None else None
+        ranks = stats.target_ranks.tolist() if stats.target_ranks is not None else None
+
+        responses: list[LogitLensResponse] = []
+        offset = 0
+
+        for row, length in enumerate(lengths):
+            seq = slice(offset, offset + len(positions[row]))
+            offset = seq.stop
+
+            logit_lens = [
+                to_lens_layer(
+                    hook_name,
+                    top_probs[i][seq],
+                    top_token_indices[i][seq],
+                    entropy[i][seq] if entropy is not None else None,
+                    ranks[i][seq] if ranks is not None else None,
+                    vocab,
+                    options.top_k,
+                )
+                for i, hook_name in enumerate(hook_names)
+            ]
+
+            responses.append(
+                LogitLensResponse(
+                    input_tokens=input_tokens[row],
+                    most_likely_token=vocab[most_likely_token_indices[0, row, 0].item()],
+                    logit_lens=logit_lens,
+                    positions=positions[row],
+                    precision=precision,
+                )
+            )
+
+    return responses
+
+
+@profiled
 def logitlens(request: LogitLensRequest, model: HookedTransformer = None):
     """Runs the input text through the selected model and returns the most probable token
-    after each model layer for each input token.
+    after each requested model layer for each requested input token.
     """
 
     if not model:
         model = load_model(request.model_name)
 
-    input = request.input
+    with metrics.stage("tokenize"):
+        tokens = model.to_tokens(request.input)
 
-    raw_resids: list[RawResid] = []
+    return lens_tokens(model, tokens, [tokens.shape[1]], request)[0]
 
-    def post_resid_filter(name: str):
-        return "resid_post" in name
 
-    def post_resid_hook(resid, hook: HookPoint):
-        raw_resids.append(RawResid(hook_name=hook.name, resid=resid))
+def logitlens_batch(request: LogitLensBatchRequest, model: HookedTransformer = None):
+    """Runs the logit lens over several inputs. Inputs are grouped into length-bucketed, right-padded
+    batches (see bucket_by_length) and each batch is run through the model in a single forward pass.
 
-    logger.info("Sending input to model...")
-    input_tokens = model.to_str_tokens(input)
+    Returns:
+        A list of LogitLensResponse in the order of request.inputs
+    """
 
-    output: Tensor = model.run_with_hooks(
-        input, fwd_hooks=[(post_resid_filter, post_resid_hook)]
-    )
+    if not model:
+        model = load_model(request.model_name)
+
+    with metrics.stage("tokenize"):
+        sequences = [model.to_tokens(input)[0] for input in request.inputs]
+    lengths = [len(seq) for seq in sequences]
+    responses: list[LogitLensResponse] = [None] * len(sequences)
+
+    for batch in bucket_by_length(lengths, config.LOGITLENS_BATCH_TOKEN_BUDGET):
+        tokens = t.nn.utils.rnn.pad_sequence(
+            [sequences[idx] for idx in batch],
+            batch_first=True,
+            padding_value=model.tokenizer.pad_token_id,
+        )
+        batch_responses = lens_tokens(model, tokens, [lengths[idx] for idx in batch], request)
+
+        for idx, response in zip(batch, batch_responses):
+            responses[idx] = response
+
+    return responses
 
-    last_logits = output[0, -1]
-    most_likely_token_index = last_logits.argmax()
-    most_likely_token = model.to_string(most_likely_token_index)
 
-    logit_lens: list[LogitLensLayer] = []
+def logitlens_stream(request: LogitLensRequest, model: HookedTransformer = None):
+    """Streaming variant of logitlens. The model is run one block at a time and each requested layer
+    is lensed and yielded as soon as its block has run, so the residuals of earlier layers are never
+    held. Final token ranks are not supported since they need the last layer before the first.
 
-    # for each post transformer block residual state
-    for result in raw_resids:
-        logits = model.unembed(model.ln_final(result.resid))
-        probs = t.softmax(logits, -1)
+    Yields:
+        A LogitLensStreamEvent with the input tokens, then one per requested layer, then one with
+        the most likely token.
+    """
+
+    if not model:
+        model = load_model(request.model_name)
+
+    if request.include_final_token_rank:
+        raise InvalidRequest("include_final_token_rank is not supported when streaming")
+
+    layers = resolve_indices(request.layers, model.cfg.n_layers, "Layer")
+    tokens = model.to_tokens(request.input)
+    if tokens.shape[1] == 0:
+        raise InvalidRequest("Every input must contain at least one token")
+    positions = resolve_indices(request.positions, tokens.shape[1], "Position")
 
-        max_probs = probs[0].max(dim=1)
-        max_token_indices = max_probs.indices
+    yield LogitLensStreamEvent(
+        input_tokens=model.to_str_tokens(tokens[0]), positions=positions
+    )
+
+    vocab = get_vocab_strings(model)
+
+    logger.info("Sending input to model...")
+
+    # Grad mode is thread local and the consumer may resume this generator on another thread, so
+    # inference mode is entered per step rather than around the yields
+    with t.inference_mode():
+        resid = model(tokens, stop_at_layer=0)
 
-        max_probs = max_probs.values.tolist()
-        max_prob_tokens = [model.to_string(idx.item()) for idx in max_token_indices]
+    for layer in range(layers[-1] + 1):
+        with t.inference_mode():
+            resid = model(resid, start_at_layer=layer, stop_at_layer=layer + 1)
+            if layer not in layers:
+                continue
+            stats = lens_stats(
+                model,
+                resid[:, positions],
+                top_k=request.top_k,
+                include_entropy=request.include_entropy,
+            )
 
-        logit_lens.append(
-            LogitLensLayer(
-                hook_name=result.hook_name,
-                max_probs=max_probs,
-                max_prob_tokens=max_prob_tokens,
+        yield LogitLensStreamEvent(
+            layer=to_lens_layer(
+                f"blocks.{layer}.hook_resid_post",
+                stats.top_probs[0].tolist(),
+                stats.top_token_indices[0].tolist(),
+                stats.entropy[0].tolist() if stats.entropy is not None else None,
+                None,
+                vocab,
+                request.top_k,
             )
         )
 
-    result: LogitLensResponse = {
-        "input_tokens": input_tokens,
-        "most_likely_token": most_likely_token,
-        "logit_lens": logit_lens,
-    }
+    with t.inference_mode():
+        most_likely_token_index = lens_stats(model, resid[:, -1:]).top_token_indices
 
-    return result
+    yield LogitLensStreamEvent(most_likely_token=vocab[most_likely_token_index.item()])
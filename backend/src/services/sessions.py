@@ -0,0 +1,298 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import NamedTuple
+import torch as t
+from torch import Tensor
+from transformer_lens import HookedTransformer
+import src.config as config
+from src.helpers import InvalidRequest
+from src.model_manager import load_model
+from src.schemas import (
+    LogitLensResponse,
+    SessionAttentionRequest,
+    SessionAttentionResponse,
+    SessionCreateRequest,
+    SessionInfo,
+    SessionLensRequest,
+    SessionNormsResponse,
+    SessionRequest,
+)
+from src.precision import model_precision
+from src.services.logitlens import get_vocab_strings, lens_stats, resolve_indices, to_lens_layer
+
+logger = logging.getLogger(__name__)
+
+
+class SessionNotFound(Exception):
+    """Raised when a session does not exist, e.g. because it expired or was evicted."""
+
+    def __init__(self, session_id: str):
+        super().__init__(f"Session {session_id} not found, it may have expired")
+        self.session_id = session_id
+
+    def __reduce__(self):
+        return (SessionNotFound, (self.session_id,))
+
+
+class ActivationSession(NamedTuple):
+    model_name: str
+    input_tokens: list[str]
+    # The model's number of layers, and the stored ones
+    n_layers: int
+    layers: list[int]
+    resids: Tensor  # [layers, pos, d_model]
+    patterns: Tensor | None  # [layers, heads, pos, pos]
+
+    def nbytes(self) -> int:
+        nbytes = self.resids.nbytes
+        if self.patterns is not None:
+            nbytes += self.patterns.nbytes
+        return nbytes
+
+
+class SessionStore:
+    """
+    The activation sessions of this process, kept on the model's device. The least recently used
+    sessions are dropped to stay within max_bytes, and sessions unused for ttl_seconds are dropped
+    on the next access.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self._lock = threading.Lock()
+        self._sessions: OrderedDict[str, ActivationSession] = OrderedDict()
+        self._last_used: dict[str, float] = {}
+        self._size = 0
+
+    def add(self, session: ActivationSession) -> str | None:
+        """Stores a session and returns its ID, or None if it is larger than the whole budget."""
+
+        nbytes = session.nbytes()
+        if nbytes > self.max_bytes:
+            return None
+
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._evict_expired()
+            while self._sessions and self._size + nbytes > self.max_bytes:
+                evicted_id = next(iter(self._sessions))
+                logger.info(f"Evicting session {evicted_id} to stay within the memory budget")
+                self._remove(evicted_id)
+
+            self._sessions[session_id] = session
+            self._last_used[session_id] = time.monotonic()
+            self._size += nbytes
+
+        return session_id
+
+    def get(self, model_name: str, session_id: str) -> ActivationSession:
+        """Returns a session and marks it as used, raising SessionNotFound if it does not exist
+        (for this model)."""
+
+        with self._lock:
+            self._evict_expired()
+            session = self._sessions.get(session_id)
+            if session is None or session.model_name != model_name:
+                raise SessionNotFound(session_id)
+
+            self._sessions.move_to_end(session_id)
+            self._last_used[session_id] = time.monotonic()
+            return session
+
+    def delete(self, model_name: str, session_id: str):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session.model_name != model_name:
+                raise SessionNotFound(session_id)
+            self._remove(session_id)
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for session_id in [
+            session_id
+            for session_id, last_used in self._last_used.items()
+            if now - last_used > self.ttl_seconds
+        ]:
+            self._remove(session_id)
+
+    def _remove(self, session_id: str):
+        session = self._sessions.pop(session_id)
+        self._last_used.pop(session_id)
+        self._size -= session.nbytes()
+
+
+session_store = SessionStore(
+    config.SESSION_MEMORY_BUDGET_MB * 2**20,
+    config.SESSION_TTL_SECONDS,
+)
+
+
+def create_session(request: SessionCreateRequest, model: HookedTransformer = None) -> SessionInfo:
+    """Runs the input through the model once and stores the residual stream after each requested
+    layer (and optionally their attention patterns) as a session, which later requests query
+    without running the model again.
+    """
+
+    if not model:
+        model = load_model(request.model_name)
+
+    layers = resolve_indices(request.layers, model.cfg.n_layers, "Layer")
+    hook_names = [f"blocks.{layer}.hook_resid_post" for layer in layers]
+    if request.include_attention:
+        hook_names += [f"blocks.{layer}.attn.hook_pattern" for layer in layers]
+
+    tokens = model.to_tokens(request.input)
+    if tokens.shape[1] == 0:
+        raise InvalidRequest("The input must contain at least one token")
+
+    with t.inference_mode():
+        _, cache = model.run_with_cache(
+            tokens,
+            names_filter=lambda name: name in hook_names,
+            stop_at_layer=layers[-1] + 1,
+        )
+
+    resids = t.stack([cache[f"blocks.{layer}.hook_resid_post"][0] for layer in layers])
+    patterns = None
+    if request.include_attention:
+        patterns = t.stack([cache[f"blocks.{layer}.attn.hook_pattern"][0] for layer in layers])
+
+    session = ActivationSession(
+        model_name=request.model_name,
+        input_tokens=model.to_str_tokens(tokens[0]),
+        n_layers=model.cfg.n_layers,
+        layers=layers,
+        resids=resids,
+        patterns=patterns,
+    )
+    session_id = session_store.add(session)
+    if session_id is None:
+        raise InvalidRequest(
+            f"The session needs {session.nbytes() / 2**20:.0f} MB, more than "
+            f"SESSION_MEMORY_BUDGET_MB"
+        )
+
+    logger.info(f"Created session {session_id} for {request.model_name} ({len(layers)} layers)")
+
+    return SessionInfo(
+        session_id=session_id,
+        input_tokens=session.input_tokens,
+        layers=layers,
+        include_attention=request.include_attention,
+        size_mb=session.nbytes() / 2**20,
+        ttl_seconds=session_store.ttl_seconds,
+    )
+
+
+def session_rows(session: ActivationSession, layers: list[int] | None) -> list[int]:
+    """Returns the indices into the session's stored layers of the requested layers (None means
+    all of them)."""
+
+    if layers is None:
+        return list(range(len(session.layers)))
+
+    rows = []
+    for layer in resolve_indices(layers, session.n_layers, "Layer"):
+        if layer not in session.layers:
+            raise InvalidRequest(f"Layer {layer} is not stored in the session")
+        rows.append(session.layers.index(layer))
+    return rows
+
+
+def session_lens(request: SessionLensRequest, model: HookedTransformer = None) -> LogitLensResponse:
+    """Applies the logit lens to the residuals stored in a session, with the same options and
+    response as logitlens.
+
+    most_likely_token is the top token of the deepest stored layer at the last position, which is
+    the model's prediction when the last layer is stored. Final token ranks need the last layer.
+    """
+
+    session = session_store.get(request.model_name, request.session_id)
+    if not model:
+        model = load_model(request.model_name)
+
+    rows = session_rows(session, request.layers)
+    positions = resolve_indices(request.positions, len(session.input_tokens), "Position")
+
+    final_token_indices = None
+    with t.inference_mode():
+        if request.include_final_token_rank:
+            if session.layers[-1] != session.n_layers - 1:
+                raise InvalidRequest("include_final_token_rank needs the last layer in the session")
+            final_stats = lens_stats(model, session.resids[-1:, positions])
+            final_token_indices = final_stats.top_token_indices[0, :, 0]
+
+        stats = lens_stats(
+            model,
+            session.resids[rows][:, positions],
+            top_k=request.top_k,
+            include_entropy=request.include_entropy,
+            target_token_indices=final_token_indices,
+        )
+        most_likely_token_index = lens_stats(model, session.resids[-1:, -1:]).top_token_indices
+
+    vocab = get_vocab_strings(model)
+    top_probs = stats.top_probs.tolist()
+    top_token_indices = stats.top_token_indices.tolist()
+    entropy = stats.entropy.tolist() if stats.entropy is not None else None
+    ranks = stats.target_ranks.tolist() if stats.target_ranks is not None else None
+
+    return LogitLensResponse(
+        input_tokens=session.input_tokens,
+        most_likely_token=vocab[most_likely_token_index.item()],
+        logit_lens=[
+            to_lens_layer(
+                f"blocks.{session.layers[row]}.hook_resid_post",
+                top_probs[i],
+                top_token_indices[i],
+                entropy[i] if entropy is not None else None,
+                ranks[i] if ranks is not None else None,
+                vocab,
+                request.top_k,
+            )
+            for i, row in enumerate(rows)
+        ],
+        positions=positions,
+        precision=model_precision(model),
+    )
+
+
+def session_norms(request: SessionRequest, model: HookedTransformer = None) -> SessionNormsResponse:
+    """Returns the L2 norm of every stored residual of a session."""
+
+    session = session_store.get(request.model_name, request.session_id)
+
+    return SessionNormsResponse(
+        layers=session.layers,
+        norms=session.resids.float().norm(dim=-1).tolist(),
+    )
+
+
+def session_attention(
+    request: SessionAttentionRequest, model: HookedTransformer = None
+) -> SessionAttentionResponse:
+    """Returns the stored attention patterns of one layer of a session."""
+
+    session = session_store.get(request.model_name, request.session_id)
+    if session.patterns is None:
+        raise InvalidRequest("The session was created without include_attention")
+
+    row = session_rows(session, [request.layer])[0]
+    heads = resolve_indices(request.heads, session.patterns.shape[1], "Head")
+
+    return SessionAttentionResponse(
+        layer=session.layers[row],
+        heads=heads,
+        patterns=session.patterns[row, heads].float().tolist(),
+    )
+
+
+def delete_session(request: SessionRequest, model: HookedTransformer = None) -> None:
+    """Drops a session before it expires."""
+
+    session_store.delete(request.model_name, request.session_id)
@@ -1,16 +1,33 @@
 from transformer_lens import HookedTransformer
 import torch as t
-import gc
-from src.helpers import load_model
+from functools import partial
+from src.helpers import InvalidRequest, bucket_by_length
+from src.model_manager import load_model
+from src.precision import model_precision
+import src.config as config
+from src.metrics import metrics
+from src.profiling import profiled
 from src.schemas import (
     RunWithSteeringRequest,
     RunWithSteeringResponse,
+    RunWithSteeringStreamEvent,
+    SteeringLayer,
+    SteeringSweepRequest,
+    SteeringSweepResult,
     SteeringVectorRequest,
+    SteeringVectorSource,
     SteeringVectorResponse,
 )
+from src.services.activation_store import ActivationSums, get_activation_store
+from src.services.logitlens import resolve_indices
+from src.services.steering_registry import load_steering_vectors, save_steering_vectors
 from transformer_lens.hook_points import HookPoint
+from transformer_lens.past_key_value_caching import (
+    HookedTransformerKeyValueCache,
+    HookedTransformerKeyValueCacheEntry,
+)
 import logging
-from typing import List, Optional
+from typing import Callable, Iterator, List, Optional
 
 
 logger = logging.getLogger(__name__)
@@ -84,63 +101,160 @@ def add_special_tokens(
     return text
 
 
-def get_activations(
+def shared_prefix_length(sequences: list[t.Tensor]) -> int:
+    """Returns the number of leading tokens shared by all sequences, leaving at least one token of
+    each sequence outside the prefix."""
+
+    length = min(len(seq) for seq in sequences) - 1
+    for seq in sequences[1:]:
+        differs = (seq[:length] != sequences[0][:length]).nonzero()
+        if len(differs):
+            length = differs[0].item()
+
+    return length
+
+
+def iter_grouped_activations(
     model: HookedTransformer,
-    prompts: list[str],
-    layer_indices: list[int] = None,
-    batch_size=16,
-):
-    """Runs the model with cache and captures the last-token residual stream vectors from the specified layers for each prompt.
+    groups: list[list[str]],
+    token_budget: int = None,
+) -> Iterator[tuple[list[tuple[int, int]], dict[int, t.Tensor]]]:
+    """Captures the last-token residual stream vectors of every layer for groups of prompts that
+    start with the same text, e.g. the same user turn followed by different assistant responses.
+
+    The tokens shared by the prompts of a group are run through the model once; the KV cache of
+    that prefix is then forked for each prompt and only the remaining tokens are run on top of it.
+    Prefixes are left-padded and suffixes right-padded, so every row's real tokens are contiguous
+    and keep their unpadded positions.
 
     Args:
         model: The model to run
-        prompts: The prompts to run through the model
-        layer_indices: The layer indicies to collect activations from. If None, collects from all
-            layers.
-        batch_size:
+        groups: The groups of prompts
+        token_budget: The maximum number of padded tokens per batch. Defaults to
+            config.STEERING_BATCH_TOKEN_BUDGET.
 
-    Returns: A dict of { layer_idx: tensor [num_prompts, d_model] } containing the last-token
-        residual stream vectors for each prompt for each specified layer.
+    Yields: For each batch, the (group index, prompt index) of each of its prompts and a dict of
+        { layer_idx: tensor [batch, d_model] } containing their last-token residual stream vectors.
     """
 
-    if not layer_indices:
-        layer_indices = list(range(model.cfg.n_layers))
+    if token_budget is None:
+        token_budget = config.STEERING_BATCH_TOKEN_BUDGET
+
+    hook_names = {f"blocks.{idx}.hook_resid_post": idx for idx in range(model.cfg.n_layers)}
+    pad_token_id = model.tokenizer.pad_token_id
+    sequences = [[model.to_tokens(prompt)[0] for prompt in group] for group in groups]
+    prefix_lengths = [shared_prefix_length(group) for group in sequences]
+    # A batch of groups runs one row per prompt, so budget for the largest group
+    max_group_size = max((len(group) for group in groups), default=1)
+    group_lengths = [max(len(seq) for seq in group) for group in sequences]
+
+    for batch in bucket_by_length(group_lengths, max(token_budget // max_group_size, 1)):
+        prefixes = [sequences[idx][0][: prefix_lengths[idx]] for idx in batch]
+        prefix_tokens = t.nn.utils.rnn.pad_sequence(
+            prefixes, batch_first=True, padding_value=pad_token_id, padding_side="left"
+        )
+        prefix_mask = t.nn.utils.rnn.pad_sequence(
+            [t.ones_like(prefix) for prefix in prefixes], batch_first=True, padding_side="left"
+        )
+
+        rows = [(idx, member) for idx in batch for member in range(len(groups[idx]))]
+        suffixes = [sequences[idx][member][prefix_lengths[idx] :] for idx, member in rows]
+        suffix_tokens = t.nn.utils.rnn.pad_sequence(
+            suffixes, batch_first=True, padding_value=pad_token_id
+        )
+        suffix_lengths = t.tensor([len(suffix) for suffix in suffixes])
+        suffix_mask = (t.arange(suffix_tokens.shape[1]) < suffix_lengths[:, None]).long()
+
+        activations = {}
+
+        def last_token_hook(resid, hook: HookPoint):
+            activations[hook_names[hook.name]] = resid[t.arange(len(rows)), suffix_lengths - 1]
+
+        with t.no_grad(), metrics.stage("activations", device=model.cfg.device) as stage:
+            kv_cache = HookedTransformerKeyValueCache.init_cache(
+                model.cfg, model.cfg.device, len(batch)
+            )
+            if prefix_tokens.shape[1]:
+                model(prefix_tokens, attention_mask=prefix_mask, past_kv_cache=kv_cache)
+
+            # Row i of the suffix batch continues the prefix of its group
+            group_rows = t.tensor([batch.index(idx) for idx, _ in rows])
+            model.run_with_hooks(
+                suffix_tokens,
+                fwd_hooks=[(lambda name: name in hook_names, last_token_hook)],
+                attention_mask=suffix_mask,
+                past_kv_cache=fork_kv_cache(kv_cache, rows=group_rows),
+            )
+        metrics.record_rate("activation", "prompts", len(rows), stage.seconds)
+
+        yield rows, activations
 
-    activations = {idx: [] for idx in layer_indices}
 
-    for i in range(0, len(prompts), batch_size):
-        batch = prompts[i : i + batch_size]
-        with t.no_grad():
-            _, cache = model.run_with_cache(batch)
+def sum_paired_activations(
+    model: HookedTransformer,
+    model_name: str,
+    positive_prompts: list[str],
+    negative_prompts: list[str],
+) -> tuple[ActivationSums, ActivationSums]:
+    """Sums the last-token residual stream vectors of every layer over the positive and over the
+    negative prompts, where positive_prompts[i] and negative_prompts[i] share the same user turn.
+
+    Each pair is run with its shared prefix prefilled once, see iter_grouped_activations. If
+    config.ACTIVATION_STORE_DIR is set, only prompts missing from the model's activation store are
+    run, their activations are stored, and the sums are read from the store.
+
+    Returns:
+        The sums of the positive and of the negative prompts
+    """
 
-        for idx in layer_indices:
-            act = cache[f"blocks.{idx}.hook_resid_post"]
-            act_final = act[:, -1, :]  # last token
-            activations[idx].append(act_final)
+    if not config.ACTIVATION_STORE_DIR:
+        sums = (ActivationSums(), ActivationSums())
+        groups = [list(pair) for pair in zip(positive_prompts, negative_prompts)]
+        for rows, batch_activations in iter_grouped_activations(model, groups):
+            for member, member_sums in enumerate(sums):
+                selected = t.tensor([row_member == member for _, row_member in rows])
+                member_sums.add({idx: acts[selected] for idx, acts in batch_activations.items()})
+        return sums
+
+    store = get_activation_store(model_name)
+    missing = set(store.missing(positive_prompts + negative_prompts))
+    groups = []
+    for idx, pair in enumerate(zip(positive_prompts, negative_prompts)):
+        group = [
+            prompt
+            for offset, prompt in zip((idx, len(positive_prompts) + idx), pair)
+            if offset in missing
+        ]
+        if group:
+            groups.append(group)
+    logger.info(
+        f"Running {len(missing)} of {2 * len(positive_prompts)} prompts not in the activation store"
+    )
 
-        t.cuda.empty_cache()
-        gc.collect()
+    for rows, batch_activations in iter_grouped_activations(model, groups):
+        store.add([groups[idx][member] for idx, member in rows], batch_activations)
 
-    # Concatenate across batches
-    return {idx: t.cat(tensors, dim=0) for idx, tensors in activations.items()}
+    return store.sum(positive_prompts), store.sum(negative_prompts)
 
 
-def calculate_mean_difference(positive_activations: dict, negative_activations: dict):
+def calculate_mean_difference(
+    positive_activations: ActivationSums, negative_activations: ActivationSums
+):
     """Calculates the steering vectors for the behavior seen from the prompts that generated the input
         positive_activations for each layer index key.
 
     Args:
-      positive_activations: a dict of [layer_idx: last_token_resid_post_vector] containing the activations from
+      positive_activations: the summed last token resid_post vectors of each layer index from
         input prompts that make the model exhibit the behavior of the steering vector you're looking for.
-      negative_activations: a dict of [layer_idx: last_token_resid_post_vector] containing the activations from
+      negative_activations: the summed last token resid_post vectors of each layer index from
         input prompts that make the model exhibit the opposite behavior of the steering vector you're looking for.
 
     Returns: A dict mapping each layer index to a tensor of shape [d_model] containing the steering vector.
     """
     steering_vectors = {}
-    for layer_idx in positive_activations.keys():
-        positive_mean = positive_activations[layer_idx].mean(dim=0)
-        negative_mean = negative_activations[layer_idx].mean(dim=0)
+    for layer_idx in positive_activations.sums.keys():
+        positive_mean = positive_activations.mean(layer_idx)
+        negative_mean = negative_activations.mean(layer_idx)
         steering_vectors[layer_idx] = positive_mean - negative_mean
 
     # L2 normalize
@@ -152,6 +266,7 @@ def calculate_mean_difference(positive_activations: dict, negative_activations:
     return steering_vectors
 
 
+@profiled
 def calculate_steering_vectors(
     request: SteeringVectorRequest, model: HookedTransformer = None
 ):
@@ -183,80 +298,385 @@ def calculate_steering_vectors(
         prompt.replace("<end_of_turn>", "") for prompt in negative_prompts
     ]
 
-    positive_activations = get_activations(model, positive_prompts_trunc)
-    negative_activations = get_activations(model, negative_prompts_trunc)
+    positive_activations, negative_activations = sum_paired_activations(
+        model, request.model_name, positive_prompts_trunc, negative_prompts_trunc
+    )
     steering_vectors = calculate_mean_difference(
         positive_activations, negative_activations
     )
 
+    steering_vector_id = save_steering_vectors(request.model_name, steering_vectors)
+
     # Convert tensors to lists for JSON serialization
-    steering_vectors_json = {
-        layer_idx: vector.tolist() for layer_idx, vector in steering_vectors.items()
-    }
+    steering_vectors_json = None
+    if request.return_vectors:
+        steering_vectors_json = {
+            layer_idx: vector.tolist() for layer_idx, vector in steering_vectors.items()
+        }
+
+    return SteeringVectorResponse(
+        steering_vectors=steering_vectors_json,
+        steering_vector_id=steering_vector_id,
+        precision=model_precision(model),
+    )
+
 
-    return SteeringVectorResponse(steering_vectors=steering_vectors_json)
+def get_steering_vectors(
+    request: SteeringVectorSource, model: HookedTransformer, layers: list[int]
+) -> dict[int, t.Tensor]:
+    """Returns the steering vectors of the requested layers as tensors, either from the registry
+    (already on the model's device) or converted from the lists sent in the request.
+
+    Raises:
+        InvalidRequest: If a layer is not one of the model's layers or has no steering vector of
+            length d_model
+    """
+
+    for layer_idx in layers:
+        if not 0 <= layer_idx < model.cfg.n_layers:
+            raise InvalidRequest(
+                f"Layer {layer_idx} is out of range for a model with {model.cfg.n_layers} layers"
+            )
+
+    if request.steering_vector_id is not None:
+        steering_vectors = load_steering_vectors(
+            request.model_name,
+            request.steering_vector_id,
+            model.cfg.device,
+            model.cfg.dtype,
+        )
+    else:
+        steering_vectors = request.steering_vectors
+
+    for layer_idx in layers:
+        if layer_idx not in steering_vectors:
+            raise InvalidRequest(f"No steering vector for layer {layer_idx}")
+        if len(steering_vectors[layer_idx]) != model.cfg.d_model:
+            raise InvalidRequest(
+                f"The steering vector of layer {layer_idx} has length "
+                f"{len(steering_vectors[layer_idx])}, expected d_model = {model.cfg.d_model}"
+            )
+
+    return {
+        layer_idx: t.as_tensor(steering_vectors[layer_idx]) for layer_idx in set(layers)
+    }
 
 
 def apply_steering_vector_hook(
     activations: t.Tensor,
     hook: HookPoint,  # The hook itself is not used but is a required argument
     steering_vector: t.Tensor,
-    scaling_factor: float,
 ) -> t.Tensor:
-    """TransformerLens hook function to apply a steering vector to all token positions."""
+    """TransformerLens hook function adding a steering vector prepared by a SteeringPlan, already
+    scaled and on the activations' device and dtype. It broadcasts over the [batch, pos] dimensions.
+    """
+
+    return activations + steering_vector
+
+
+class SteeringPlan:
+    """
+    The steering of the rows of a batched generation, with the vector added at each layer scaled per
+    row and position and placed on the model's device and dtype once, so that the hooks run on every
+    decode step only add them.
+
+    Each row is a list of SteeringLayers, empty for an unsteered row. The prompt vector of a layer
+    is [rows, pos, d_model], or [rows, 1, d_model] when no row restricts its positions. The decode
+    vector is [rows, 1, d_model], and the layer is not hooked while decoding when no row steers the
+    generated tokens at that layer.
+
+    Args:
+        model: The model to steer
+        steering_vectors: The steering vectors dict mapping layer indices to tensors
+        rows: The steering of each row
+        prompt_length: The number of prompt tokens
+    """
+
+    def __init__(
+        self,
+        model: HookedTransformer,
+        steering_vectors: dict[int, t.Tensor],
+        rows: list[list[SteeringLayer]],
+        prompt_length: int,
+    ):
+        self.layers = sorted({steering.layer for row in rows for steering in row})
+        self.prompt_vectors: dict[int, t.Tensor] = {}
+        self.decode_vectors: dict[int, t.Tensor] = {}
+
+        device, dtype = model.cfg.device, model.cfg.dtype
+        for layer_idx in self.layers:
+            layer_steering = [
+                [steering for steering in row if steering.layer == layer_idx] for row in rows
+            ]
+            any_positions = any(
+                steering.positions is not None for row in layer_steering for steering in row
+            )
+
+            # The scaling factor of each row at each prompt position and at the generated tokens
+            prompt_scales = t.zeros(len(rows), prompt_length if any_positions else 1)
+            decode_scales = t.zeros(len(rows), 1)
+            for row_idx, row in enumerate(layer_steering):
+                for steering in row:
+                    if steering.positions is None:
+                        prompt_scales[row_idx] += steering.scaling_factor
+                    else:
+                        positions = resolve_indices(steering.positions, prompt_length, "Position")
+                        prompt_scales[row_idx, positions] += steering.scaling_factor
+                    if steering.steer_generated:
+                        decode_scales[row_idx] += steering.scaling_factor
+
+            # Scaled in fp32 and only then converted to the model's dtype
+            vector = steering_vectors[layer_idx].to(device=device, dtype=t.float32)
+            self.prompt_vectors[layer_idx] = (
+                prompt_scales.to(device)[:, :, None] * vector
+            ).to(dtype)
+            if decode_scales.any():
+                self.decode_vectors[layer_idx] = (
+                    decode_scales.to(device)[:, :, None] * vector
+                ).to(dtype)
+
+    @staticmethod
+    def _hooks(vectors: dict[int, t.Tensor]) -> list[tuple[str, Callable]]:
+        return [
+            (
+                f"blocks.{layer_idx}.hook_resid_post",
+                partial(apply_steering_vector_hook, steering_vector=vector),
+            )
+            for layer_idx, vector in vectors.items()
+        ]
+
+    def prompt_hooks(self) -> list[tuple[str, Callable]]:
+        """The forward hooks steering a forward pass over the prompt."""
+
+        return self._hooks(self.prompt_vectors)
+
+    def decode_hooks(self) -> list[tuple[str, Callable]]:
+        """The forward hooks steering a forward pass over one generated token per row."""
+
+        return self._hooks(self.decode_vectors)
+
+
+def prefill_prompt(
+    model: HookedTransformer, tokens: t.Tensor, stop_at_layer: int
+) -> tuple[t.Tensor, HookedTransformerKeyValueCache]:
+    """Runs the prompt through the blocks below stop_at_layer once, storing their keys and values.
 
-    # Ensure the steering vector is on the same device as the activations
-    scaled_steering_vector = (scaling_factor * steering_vector).to(
-        device=activations.device, dtype=activations.dtype
+    Args:
+        model: The model to run
+        tokens: The [batch, pos] prompt tokens
+        stop_at_layer: The first block that is not run
+
+    Returns:
+        The residual stream after the last block that was run and the KV cache holding the prefilled
+        entries of those blocks
+    """
+
+    kv_cache = HookedTransformerKeyValueCache.init_cache(
+        model.cfg, model.cfg.device, tokens.shape[0]
     )
+    resid = model(
+        tokens,
+        stop_at_layer=stop_at_layer,
+        past_kv_cache=kv_cache,
+        attention_mask=t.ones_like(tokens),
+    )
+    return resid, kv_cache
+
 
-    # # Add the steering vector to all token positions.
-    # # The vector [d_model] will be broadcast across the [batch, position] dimensions.
-    activations = activations + scaled_steering_vector
+def fork_kv_cache(
+    kv_cache: HookedTransformerKeyValueCache,
+    batch_size: Optional[int] = None,
+    rows: Optional[t.Tensor] = None,
+) -> HookedTransformerKeyValueCache:
+    """Returns a copy of the KV cache that can be extended independently of the original. Appending
+    to an entry concatenates into a new tensor, so the prefilled tensors are shared, not copied.
 
-    # activations = activations.clone()
-    # activations[:, -1, :] = activations[:, -1, :] + scaled_steering_vector
-    return activations
+    Args:
+        kv_cache: A KV cache, with a batch size of 1 if batch_size is given
+        batch_size: If given, the cache is broadcast to this many rows
+        rows: If given, row i of the fork is row rows[i] of the cache
 
+    Returns:
+        The forked KV cache
+    """
 
-def generate_with_steering(
+    def expand(tensor: t.Tensor) -> t.Tensor:
+        if rows is not None:
+            return tensor[rows]
+        if batch_size is None:
+            return tensor
+        return tensor.expand(batch_size, *tensor.shape[1:])
+
+    return HookedTransformerKeyValueCache(
+        entries=[
+            HookedTransformerKeyValueCacheEntry(
+                expand(entry.past_keys), expand(entry.past_values)
+            )
+            for entry in kv_cache.entries
+        ],
+        previous_attention_mask=expand(kv_cache.previous_attention_mask),
+    )
+
+
+def iter_greedy_decode(
     model: HookedTransformer,
-    prompt: str,
+    logits: t.Tensor,
+    kv_cache: HookedTransformerKeyValueCache,
+    max_tokens: int,
+    hooks: list[tuple[str, Callable]] = (),
+) -> Iterator[tuple[t.Tensor, t.Tensor]]:
+    """Greedily decodes from the prompt logits using the KV cache, stopping at the EOS token like
+    model.generate.
+
+    Args:
+        model: The model to run
+        logits: The [batch, pos, d_vocab] logits of the prompt
+        kv_cache: The KV cache holding the prompt
+        max_tokens: The maximum number of tokens to generate
+        hooks: Forward hooks added around each decode step. They are never registered while the
+            generator is suspended, so other work can use the model between steps.
+
+    Yields:
+        At each step, the [batch] generated tokens and a [batch] mask of the sequences that are
+        done. Sequences that are done are padded with the EOS token.
+    """
+
+    eos_token_id = model.tokenizer.eos_token_id
+    done = t.zeros(logits.shape[0], dtype=t.bool, device=logits.device)
+    # Throughput counts the tokens of unfinished rows over the time spent in decode steps only
+    generated_tokens = 0
+    decode_seconds = 0.0
+
+    try:
+        for i in range(max_tokens):
+            next_tokens = logits[:, -1].argmax(dim=-1)
+            next_tokens[done] = eos_token_id
+            done = done | (next_tokens == eos_token_id)
+            if i == max_tokens - 1:
+                done = t.ones_like(done)
+
+            yield next_tokens, done
+
+            if done.all():
+                return
+
+            # Grad mode is thread local and a consumer may resume this generator on another thread
+            with (
+                model.hooks(fwd_hooks=hooks),
+                t.no_grad(),
+                metrics.stage("generate", device=logits.device) as stage,
+            ):
+                logits = model(
+                    next_tokens[:, None],
+                    past_kv_cache=kv_cache,
+                    attention_mask=t.ones_like(next_tokens[:, None]),
+                )
+            if metrics.enabled:
+                generated_tokens += int((~done).sum())
+                decode_seconds += stage.seconds
+    finally:
+        metrics.record_rate("generation", "tokens", generated_tokens, decode_seconds)
+
+
+def iter_decode_rows(
+    model: HookedTransformer,
+    tokens: t.Tensor,
     steering_vectors: dict[int, t.Tensor],
-    layer_idx: int,
-    scaling_factor=1.0,
+    rows: list[list[SteeringLayer]],
     max_tokens: int = 100,
-):
-    """Generates a response using the prompt and steering vector application params.
+) -> Iterator[tuple[t.Tensor, t.Tensor]]:
+    """Greedily decodes one continuation of the prompt tokens per row, all rows in a single batched
+    decode loop.
+
+    Each row is steered at any number of layers, see SteeringPlan; an empty row is unsteered. The
+    blocks up to the first steered layer compute the same prompt keys and values for every row, so
+    the prompt is prefilled through them once and the KV cache is then broadcast to all rows. The
+    hooks are only registered during each forward pass, and removed even if it fails.
 
     Args:
         model: The model to run
-        prompt: The prompt to input to the model
+        tokens: The [1, pos] prompt tokens
         steering_vectors: The steering vectors dict mapping layer indices to tensors
-        layer_idx: The layer index to apply the steering vector to
-        scaling_factor: The scaling factor to apply to the steering vector
+        rows: The steering of each row
         max_tokens: The maximum number of tokens to generate
 
-    Returns:
-        The generated raw response
+    Yields:
+        At each step, the [rows] generated tokens and [rows] done mask, on the CPU
     """
-    steering_vector_at_layer = steering_vectors[layer_idx]
 
-    def specific_steering_hook(activations, hook):
-        return apply_steering_vector_hook(
-            activations, hook, steering_vector_at_layer, scaling_factor
+    plan = SteeringPlan(model, steering_vectors, rows, tokens.shape[1])
+    # Without steering the whole prompt is shared
+    shared_layers = plan.layers[0] + 1 if plan.layers else model.cfg.n_layers
+
+    with t.no_grad(), metrics.stage("prefill", device=tokens.device):
+        resid, shared_kv_cache = prefill_prompt(model, tokens, shared_layers)
+    kv_cache = fork_kv_cache(shared_kv_cache, batch_size=len(rows))
+    if plan.layers:
+        # The first steered layer is the last prefilled block
+        resid = resid + plan.prompt_vectors[plan.layers[0]]
+    else:
+        resid = resid.expand(len(rows), -1, -1)
+
+    with model.hooks(fwd_hooks=plan.prompt_hooks()), t.no_grad():
+        logits = model(
+            resid,
+            start_at_layer=shared_layers,
+            past_kv_cache=kv_cache,
+            attention_mask=kv_cache.previous_attention_mask,
         )
 
-    with t.no_grad():
-        model.add_hook(f"blocks.{layer_idx}.hook_resid_post", specific_steering_hook)
-        response = model.generate(
-            prompt,
-            max_new_tokens=max_tokens,
-            eos_token_id=model.tokenizer.eos_token_id,
-            do_sample=False,
-        )
-        model.reset_hooks()
-    return response
+    decode_hooks = plan.decode_hooks()
+    for next_tokens, done in iter_greedy_decode(model, logits, kv_cache, max_tokens, decode_hooks):
+        yield next_tokens.cpu(), done.cpu()
+
+
+def iter_generate_rows(
+    model: HookedTransformer,
+    prompt: str,
+    steering_vectors: dict[int, t.Tensor],
+    rows: list[list[SteeringLayer]],
+    max_tokens: int = 100,
+) -> Iterator[tuple[int, str]]:
+    """Generates one response to the prompt per row with iter_decode_rows.
+
+    Yields:
+        (row index, raw response including the prompt) for each row, as soon as it is done
+    """
+
+    tokens = model.to_tokens(prompt)
+    generated: list[t.Tensor] = []
+    reported = t.zeros(len(rows), dtype=t.bool)
+
+    for next_tokens, done in iter_decode_rows(
+        model, tokens, steering_vectors, rows, max_tokens
+    ):
+        generated.append(next_tokens)
+
+        for row in (done & ~reported).nonzero().flatten().tolist():
+            row_tokens = t.cat([tokens[0].cpu()] + [step[row : row + 1] for step in generated])
+            yield row, model.tokenizer.decode(row_tokens, skip_special_tokens=True)
+
+        reported = done
+
+
+def generate_rows(
+    model: HookedTransformer,
+    prompt: str,
+    steering_vectors: dict[int, t.Tensor],
+    rows: list[list[SteeringLayer]],
+    max_tokens: int = 100,
+) -> list[str]:
+    """Runs iter_generate_rows to completion.
+
+    Returns:
+        The raw response of each row, including the prompt
+    """
+
+    responses = [None] * len(rows)
+    for row, response in iter_generate_rows(model, prompt, steering_vectors, rows, max_tokens):
+        responses[row] = response
+
+    return responses
 
 
 def clean_response(model_response: str, model_name: str):
@@ -276,35 +696,32 @@ def clean_response(model_response: str, model_name: str):
     return response
 
 
+@profiled
 def run_with_steering(request: RunWithSteeringRequest, model: HookedTransformer = None):
     """
     Adds the model's special tokens to the prompt, generates a response with and without steering,
-        and returns the cleaned responses.
+        and returns the cleaned responses. All the steered layers apply within one generation.
     """
 
     if not model:
         model = load_model(request.model_name)
 
-    # Convert steering vectors from lists back to tensors
-    steering_vectors = {
-        layer_idx: t.tensor(vector)
-        for layer_idx, vector in request.steering_vectors.items()
-    }
+    steering = request.steering_layers()
+    steering_vectors = get_steering_vectors(
+        request, model, [steering_layer.layer for steering_layer in steering]
+    )
 
     prompt_with_special_tokens = add_special_tokens(
         request.prompt, model.tokenizer, system_prompt=None
     )
 
-    raw_steered_response = generate_with_steering(
+    # The steered and unsteered responses are decoded together as a batch of two
+    raw_steered_response, raw_unsteered_response = generate_rows(
         model,
         prompt_with_special_tokens,
         steering_vectors,
-        request.layer,
-        request.scaling_factor,
-        request.max_tokens,
-    )
-    raw_unsteered_response = model.generate(
-        prompt_with_special_tokens, max_new_tokens=request.max_tokens
+        rows=[steering, []],
+        max_tokens=request.max_tokens,
     )
 
     steered_response = clean_response(raw_steered_response, request.model_name)
@@ -313,4 +730,106 @@ def run_with_steering(request: RunWithSteeringRequest, model: HookedTransformer
     return RunWithSteeringResponse(
         steered_response=steered_response,
         unsteered_response=unsteered_response,
+        precision=model_precision(model),
     )
+
+
+def sweep_steering(request: SteeringSweepRequest, model: HookedTransformer = None):
+    """Generates a response for every (layer, scaling factor) pair of the request, plus an unsteered
+    response if requested. Configurations are generated as rows of batches of at most
+    config.STEERING_SWEEP_MAX_BATCH_SIZE, sorted by layer so that rows sharing a batch also share
+    most of the prompt prefill.
+
+    Yields:
+        A SteeringSweepResult for each configuration, as soon as its generation is done
+    """
+
+    if not model:
+        model = load_model(request.model_name)
+
+    steering_vectors = get_steering_vectors(request, model, request.layers)
+
+    configs: list[tuple[Optional[int], Optional[float]]] = [
+        (layer_idx, scaling_factor)
+        for layer_idx in sorted(set(request.layers), reverse=True)
+        for scaling_factor in request.scaling_factors
+    ]
+    if request.include_unsteered:
+        configs.insert(0, (None, None))
+
+    prompt_with_special_tokens = add_special_tokens(
+        request.prompt, model.tokenizer, system_prompt=None
+    )
+    batch_size = config.STEERING_SWEEP_MAX_BATCH_SIZE
+    precision = model_precision(model)
+
+    for i in range(0, len(configs), batch_size):
+        batch = configs[i : i + batch_size]
+        rows = [
+            [SteeringLayer(layer=layer_idx, scaling_factor=scaling_factor)]
+            if layer_idx is not None
+            else []
+            for layer_idx, scaling_factor in batch
+        ]
+
+        for row, raw_response in iter_generate_rows(
+            model, prompt_with_special_tokens, steering_vectors, rows, request.max_tokens
+        ):
+            layer_idx, scaling_factor = batch[row]
+            yield SteeringSweepResult(
+                layer=layer_idx,
+                scaling_factor=scaling_factor,
+                response=clean_response(raw_response, request.model_name),
+                precision=precision,
+            )
+
+
+def stream_with_steering(request: RunWithSteeringRequest, model: HookedTransformer = None):
+    """Streaming variant of run_with_steering. The steered and unsteered responses are decoded as a
+    batch of two and their text is yielded as the tokens are generated. Only the generated token ids
+    are decoded, so there is no template to strip from the text. Closing the generator stops the
+    decode loop.
+
+    Yields:
+        RunWithSteeringStreamEvents with the new text of either response, and a final event with
+        done=True for each of them
+    """
+
+    if not model:
+        model = load_model(request.model_name)
+
+    steering = request.steering_layers()
+    steering_vectors = get_steering_vectors(
+        request, model, [steering_layer.layer for steering_layer in steering]
+    )
+    prompt_with_special_tokens = add_special_tokens(
+        request.prompt, model.tokenizer, system_prompt=None
+    )
+    tokens = model.to_tokens(prompt_with_special_tokens)
+
+    branches = ["steered", "unsteered"]
+    generated: list[list[int]] = [[], []]
+    texts = ["", ""]
+    reported = [False, False]
+
+    for next_tokens, done in iter_decode_rows(
+        model,
+        tokens,
+        steering_vectors,
+        rows=[steering, []],
+        max_tokens=request.max_tokens,
+    ):
+        for row, branch in enumerate(branches):
+            if reported[row]:
+                continue
+
+            generated[row].append(next_tokens[row].item())
+            text = model.tokenizer.decode(generated[row], skip_special_tokens=True)
+            # Hold back incomplete multi-byte characters until the next token completes them
+            if not text.endswith("\ufffd") and len(text) > len(texts[row]):
+                yield RunWithSteeringStreamEvent(branch=branch, text=text[len(texts[row]) :])
+                texts[row] = text
+
+            if done[row]:
+                reported[row] = True
+                yield RunWithSteeringStreamEvent(branch=branch, text="", done=True)
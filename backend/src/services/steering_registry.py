@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+import torch as t
+from safetensors import safe_open
+from safetensors.torch import save_file
+import src.config as config
+from src.helpers import InvalidRequest
+
+logger = logging.getLogger(__name__)
+
+
+class SteeringVectorNotFound(Exception):
+    """Raised when the registry holds no steering vectors with the requested ID."""
+
+    def __init__(self, vector_id: str):
+        super().__init__(f"Unknown steering vector ID {vector_id}")
+        self.vector_id = vector_id
+
+    def __reduce__(self):
+        return (SteeringVectorNotFound, (self.vector_id,))
+
+
+# Device-resident steering vectors as (model name, layers, [layers, d_model] tensor), keyed by
+# (vector_id, device, dtype). Used from the inference worker thread of every model, so it is only
+# accessed with _device_vectors_lock held.
+_device_vectors: OrderedDict[tuple[str, str, t.dtype], tuple[str, list[int], t.Tensor]] = (
+    OrderedDict()
+)
+_device_vectors_lock = threading.Lock()
+
+
+def _vector_path(vector_id: str) -> str:
+    return os.path.join(config.STEERING_VECTOR_DIR, f"{vector_id}.safetensors")
+
+
+def save_steering_vectors(model_name: str, steering_vectors: dict[int, t.Tensor]) -> str:
+    """Stores the steering vectors of a model in the registry as a single [layers, d_model]
+    safetensors array in config.STEERING_VECTOR_DTYPE.
+
+    Args:
+        model_name: The name of the model the vectors were calculated for
+        steering_vectors: A dict mapping each layer index to a [d_model] steering vector
+
+    Returns:
+        The ID of the stored vectors, a hash of the model name and their contents
+    """
+
+    layers = sorted(steering_vectors.keys())
+    dtype = getattr(t, config.STEERING_VECTOR_DTYPE)
+    stacked = t.stack([steering_vectors[layer] for layer in layers]).to("cpu", dtype).contiguous()
+
+    digest = hashlib.sha256(model_name.encode())
+    digest.update(json.dumps(layers).encode())
+    digest.update(stacked.view(t.uint8).numpy().tobytes())
+    vector_id = digest.hexdigest()[:16]
+
+    path = _vector_path(vector_id)
+    if not os.path.exists(path):
+        os.makedirs(config.STEERING_VECTOR_DIR, exist_ok=True)
+        # Write then rename so a crash never leaves a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        save_file(
+            {"steering_vectors": stacked},
+            tmp_path,
+            metadata={"model_name": model_name, "layers": json.dumps(layers)},
+        )
+        os.replace(tmp_path, path)
+        logger.info(f"Saved steering vectors {vector_id} for {model_name}")
+
+    return vector_id
+
+
+def has_steering_vectors(vector_id: str) -> bool:
+    """Returns whether the registry holds the steering vectors with the given ID."""
+
+    return os.path.exists(_vector_path(vector_id))
+
+
+def load_steering_vectors(
+    model_name: str, vector_id: str, device: t.device | str, dtype: t.dtype
+) -> dict[int, t.Tensor]:
+    """Returns the registered steering vectors of a model on the given device and dtype.
+
+    The file is memory-mapped and the converted tensor is cached, so repeated runs with the same
+    vectors neither read the file nor copy it to the device again.
+
+    Args:
+        model_name: The name of the model the vectors are used with
+        vector_id: The ID returned by save_steering_vectors
+        device: The device to place the vectors on
+        dtype: The dtype to convert the vectors to
+
+    Returns:
+        A dict mapping each layer index to a [d_model] steering vector (views of one tensor)
+
+    Raises:
+        SteeringVectorNotFound: If the ID is not in the registry
+        InvalidRequest: If the vectors were calculated for another model
+    """
+
+    key = (vector_id, str(device), dtype)
+
+    with _device_vectors_lock:
+        entry = _device_vectors.get(key)
+        if entry is not None:
+            _device_vectors.move_to_end(key)
+
+    if entry is None:
+        if not has_steering_vectors(vector_id):
+            raise SteeringVectorNotFound(vector_id)
+
+        # Read outside the lock so that other models' lookups do not wait for the file
+        with safe_open(_vector_path(vector_id), framework="pt") as f:
+            metadata = f.metadata()
+            entry = (
+                metadata["model_name"],
+                json.loads(metadata["layers"]),
+                f.get_tensor("steering_vectors").to(device, dtype),
+            )
+
+        with _device_vectors_lock:
+            _device_vectors[key] = entry
+            while len(_device_vectors) > config.STEERING_VECTOR_CACHE_SIZE:
+                _device_vectors.popitem(last=False)
+
+    vectors_model_name, layers, stacked = entry
+    if vectors_model_name != model_name:
+        raise InvalidRequest(
+            f"Steering vectors {vector_id} belong to {vectors_model_name}, not {model_name}"
+        )
+
+    return {layer: stacked[i] for i, layer in enumerate(layers)}
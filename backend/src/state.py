@@ -1,3 +1,6 @@
 model_expirations = {}
 
 loaded_models = {}
+
+# Decoded string for every token id, keyed by model name (see services/logitlens.py)
+vocab_strings = {}
@@ -0,0 +1,114 @@
+import importlib.metadata
+import json
+import logging
+import os
+import shutil
+import torch as t
+from safetensors.torch import load_file, save_file
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+import src.config as config
+
+logger = logging.getLogger(__name__)
+
+
+def _cache_dir(model_name: str, dtype: t.dtype) -> str:
+    dtype_name = str(dtype).removeprefix("torch.")
+    version = importlib.metadata.version("transformer_lens")
+    return os.path.join(
+        config.WEIGHTS_CACHE_DIR,
+        f"{model_name.replace('/', '--')}-{dtype_name}-tl{version}",
+    )
+
+
+def load_pretrained(
+    model_name: str, device: t.device | str, dtype: t.dtype = t.float32
+) -> HookedTransformer:
+    """Loads a pretrained model, converting the HF checkpoint to TransformerLens weights only the
+    first time.
+
+    The converted state dict and config are stored in config.WEIGHTS_CACHE_DIR, keyed by model name,
+    dtype and TransformerLens version. Later loads build the model on the meta device and assign the
+    memory-mapped tensors to it, so neither the conversion nor a weight initialization is repeated.
+
+    Args:
+        model_name: The name of the model to load
+        device: The device to place the model on
+        dtype: The dtype of the weights
+
+    Returns:
+        The loaded model
+    """
+
+    if not config.WEIGHTS_CACHE_DIR:
+        return HookedTransformer.from_pretrained(
+            model_name, device=device, dtype=dtype, default_prepend_bos=False
+        )
+
+    cache_dir = _cache_dir(model_name, dtype)
+    if os.path.exists(cache_dir):
+        try:
+            return _load_converted(cache_dir, device)
+        except Exception as e:
+            logger.warning(f"Could not load converted weights from {cache_dir}: {e}")
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    model = HookedTransformer.from_pretrained(
+        model_name, device=device, dtype=dtype, default_prepend_bos=False
+    )
+    # The model is loaded either way, so a failed save only costs the next load a conversion
+    try:
+        _save_converted(model, cache_dir)
+    except Exception as e:
+        logger.warning(f"Could not save converted weights to {cache_dir}: {e}")
+    return model
+
+
+def _load_converted(cache_dir: str, device: t.device | str) -> HookedTransformer:
+    with open(os.path.join(cache_dir, "config.json")) as f:
+        cfg_dict = json.load(f)
+    cfg_dict["dtype"] = getattr(t, cfg_dict["dtype"])
+    cfg_dict["device"] = str(device)
+    cfg = HookedTransformerConfig.from_dict(cfg_dict)
+
+    with t.device("meta"):
+        model = HookedTransformer(cfg, move_to_device=False)
+
+    # On the CPU the tensors stay memory-mapped; pages are read when first used
+    state_dict = load_file(os.path.join(cache_dir, "model.safetensors"), device=str(device))
+    model.load_state_dict(state_dict, strict=True, assign=True)
+    model.eval()
+
+    logger.info(f"Loaded converted weights from {cache_dir}")
+    return model
+
+
+def _save_converted(model: HookedTransformer, cache_dir: str):
+    # safetensors refuses tensors that share memory, so duplicates are cloned
+    state_dict = {}
+    storages = set()
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.contiguous()
+        if tensor.untyped_storage().data_ptr() in storages:
+            tensor = tensor.clone()
+        storages.add(tensor.untyped_storage().data_ptr())
+        state_dict[name] = tensor
+
+    cfg_dict = dict(model.cfg.to_dict())  # to_dict returns the config's own __dict__
+    cfg_dict["dtype"] = str(cfg_dict["dtype"]).removeprefix("torch.")
+    cfg_dict["device"] = None
+
+    # Write to a temporary directory then rename, so a crash never leaves a partial cache entry
+    tmp_dir = f"{cache_dir}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        save_file(state_dict, os.path.join(tmp_dir, "model.safetensors"))
+        with open(os.path.join(tmp_dir, "config.json"), "w") as f:
+            json.dump(cfg_dict, f)
+        if os.path.exists(cache_dir):
+            # Another process saved the same conversion first
+            return
+        os.replace(tmp_dir, cache_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    logger.info(f"Saved converted weights to {cache_dir}")
@@ -0,0 +1,136 @@
+import asyncio
+import unittest
+from unittest import mock
+import httpx
+from benchmarks.synthetic import synthetic_model
+import src.backends
+import src.config as config
+import src.state as state
+from src.backends.fake_modal import FakeModalRunner
+from src.backends.modal_backend import ModalRunnerBackend
+from src.helpers import update_model_expiration
+from src.main import app
+from src.result_cache import result_cache
+
+MODEL_NAME = "synthetic-tiny"
+
+
+class CountingRunner(FakeModalRunner):
+    """FakeModalRunner recording how many calls are in flight at once."""
+
+    in_flight = 0
+    max_in_flight = 0
+
+    async def _run(self, method, request):
+        CountingRunner.in_flight += 1
+        CountingRunner.max_in_flight = max(CountingRunner.max_in_flight, CountingRunner.in_flight)
+        try:
+            return await super()._run(method, request)
+        finally:
+            CountingRunner.in_flight -= 1
+
+
+class FakeModalBackendTest(unittest.IsolatedAsyncioTestCase):
+    """Runs requests through the API with RUNNER_BACKEND=fake_modal, on a synthetic model loaded in
+    this process."""
+
+    @classmethod
+    def setUpClass(cls):
+        state.loaded_models[MODEL_NAME] = synthetic_model("tiny")
+        update_model_expiration(MODEL_NAME)
+
+    @classmethod
+    def tearDownClass(cls):
+        state.loaded_models.pop(MODEL_NAME, None)
+
+    def use_backend(self, runner_factory, max_concurrent_requests=8, timeout_seconds=300):
+        """Makes the API use a ModalRunnerBackend calling runner_factory's runners."""
+
+        patches = [
+            mock.patch.object(config, "RUNNER_BACKEND", "fake_modal"),
+            mock.patch.object(config, "MODAL_MAX_CONCURRENT_REQUESTS", max_concurrent_requests),
+            mock.patch.object(config, "MODAL_REQUEST_TIMEOUT_SECONDS", timeout_seconds),
+            # Every request reaches the runner
+            mock.patch.object(result_cache, "max_bytes", 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        backend = ModalRunnerBackend(runner_factory=runner_factory)
+        patch = mock.patch.object(src.backends, "_backend", backend)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return backend
+
+    def client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+    async def test_concurrent_requests_are_limited_per_model(self):
+        CountingRunner.in_flight = CountingRunner.max_in_flight = 0
+        factory = mock.Mock(
+            side_effect=lambda model_name: CountingRunner(model_name, latency_seconds=0.05)
+        )
+        self.use_backend(factory, max_concurrent_requests=2)
+
+        async with self.client() as client:
+            responses = await asyncio.gather(
+                *(
+                    client.post("/logitlens", json={"model_name": MODEL_NAME, "input": f"w{i}"})
+                    for i in range(8)
+                )
+            )
+
+        self.assertEqual([response.status_code for response in responses], [200] * 8)
+        self.assertEqual(CountingRunner.max_in_flight, 2)
+        # The runner handle is created once and reused by every request
+        factory.assert_called_once_with(MODEL_NAME)
+
+    async def test_slow_call_returns_504(self):
+        self.use_backend(
+            lambda model_name: FakeModalRunner(model_name, latency_seconds=5),
+            timeout_seconds=0.2,
+        )
+
+        async with self.client() as client:
+            response = await client.post(
+                "/logitlens", json={"model_name": MODEL_NAME, "input": "w1 w2"}
+            )
+
+        self.assertEqual(response.status_code, 504)
+        self.assertIn("timed out", response.json()["detail"])
+
+    async def test_slow_stream_returns_504(self):
+        self.use_backend(
+            lambda model_name: FakeModalRunner(model_name, latency_seconds=5),
+            timeout_seconds=0.2,
+        )
+
+        async with self.client() as client:
+            response = await client.post(
+                "/logitlens/stream", json={"model_name": MODEL_NAME, "input": "w1 w2"}
+            )
+
+        self.assertEqual(response.status_code, 504)
+
+    async def test_waiting_for_a_slot_counts_towards_the_timeout(self):
+        self.use_backend(
+            lambda model_name: FakeModalRunner(model_name, latency_seconds=0.5),
+            max_concurrent_requests=1,
+            timeout_seconds=0.8,
+        )
+
+        async with self.client() as client:
+            responses = await asyncio.gather(
+                *(
+                    client.post("/logitlens", json={"model_name": MODEL_NAME, "input": f"w{i}"})
+                    for i in range(3)
+                )
+            )
+
+        # The first request runs at once, the others time out waiting for its slot
+        self.assertEqual(sorted(response.status_code for response in responses), [200, 504, 504])
+
+
+if __name__ == "__main__":
+    unittest.main()
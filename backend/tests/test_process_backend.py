@@ -0,0 +1,99 @@
+import asyncio
+import unittest
+from unittest import mock
+from benchmarks.synthetic import SIZES, synthetic_model
+import src.state as state
+from src.backends.process import ProcessRunnerBackend, _serve_requests
+from src.helpers import update_model_expiration
+from src.schemas import LogitLensRequest, RunWithSteeringRequest
+
+MODEL_NAME = "synthetic-tiny"
+
+# Spawning a runner and building its model takes a few seconds
+TIMEOUT = 120
+
+
+def _serve_synthetic(conn, model_name: str, torch_threads: int):
+    """Runner process entry point serving a synthetic model, which needs no download."""
+
+    state.loaded_models[model_name] = synthetic_model("tiny")
+    update_model_expiration(model_name)
+    asyncio.run(_serve_requests(conn, model_name))
+
+
+def _serve_garbage(conn, model_name: str, torch_threads: int):
+    """Runner process entry point answering the first request with bytes that do not unpickle."""
+
+    conn.recv()
+    conn.send_bytes(b"not a pickle")
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+
+
+class ProcessRunnerBackendTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.backend = ProcessRunnerBackend()
+
+    async def asyncTearDown(self):
+        await self.backend.close()
+
+    def serve(self, target):
+        return mock.patch("src.backends.process._serve", target)
+
+    async def test_runs_requests_and_reports_model_states(self):
+        with self.serve(_serve_synthetic):
+            response = await asyncio.wait_for(
+                self.backend.run(
+                    MODEL_NAME, "logitlens", LogitLensRequest(model_name=MODEL_NAME, input="w1 w2")
+                ),
+                TIMEOUT,
+            )
+        self.assertEqual(response.input_tokens, ["w1", "w2"])
+
+        model_states = await asyncio.wait_for(self.backend.model_states(), TIMEOUT)
+        self.assertEqual(list(model_states), [MODEL_NAME])
+        self.assertIn(MODEL_NAME, model_states[MODEL_NAME].models)
+
+    async def test_unreadable_reply_fails_the_request_and_restarts_the_process(self):
+        request = LogitLensRequest(model_name=MODEL_NAME, input="w1 w2")
+
+        with self.serve(_serve_garbage):
+            with self.assertRaisesRegex(RuntimeError, "Could not read a reply"):
+                await asyncio.wait_for(self.backend.run(MODEL_NAME, "logitlens", request), TIMEOUT)
+        process = self.backend._processes[MODEL_NAME]
+        self.assertFalse(process.is_alive())
+
+        with self.serve(_serve_synthetic):
+            response = await asyncio.wait_for(
+                self.backend.run(MODEL_NAME, "logitlens", request), TIMEOUT
+            )
+        self.assertIsNot(self.backend._processes[MODEL_NAME], process)
+        self.assertEqual(response.input_tokens, ["w1", "w2"])
+
+    async def test_killed_process_fails_the_stream(self):
+        with self.serve(_serve_synthetic):
+            d_model = SIZES["tiny"][1]
+            request = RunWithSteeringRequest(
+                model_name=MODEL_NAME,
+                prompt="w1",
+                steering_vectors={0: [0.0] * d_model},
+                layer=0,
+                max_tokens=200,
+            )
+            items = await asyncio.wait_for(
+                self.backend.stream(MODEL_NAME, "stream_with_steering", request), TIMEOUT
+            )
+            await asyncio.wait_for(anext(items), TIMEOUT)
+
+            self.backend._processes[MODEL_NAME].process.kill()
+            with self.assertRaisesRegex(RuntimeError, "runner process exited"):
+                async with asyncio.timeout(TIMEOUT):
+                    async for _ in items:
+                        pass
+            await items.aclose()
+
+
+if __name__ == "__main__":
+    unittest.main()